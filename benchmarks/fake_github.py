@@ -0,0 +1,174 @@
+"""A local imitation of the parts of the github API that the crawler uses.
+
+The server has a configurable response latency and rate-limit budget, so we can measure how
+the crawler behaves with a slow network and when it runs out of budget, without using any of
+our real github budget.
+"""
+import json
+import threading
+import time
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class FakeGithub(object):
+    """Serve the stargazers of repositories, and the profiles of their star-gazers.
+
+    Args:
+        stars: a list of (starred_at, user profile) tuples, in starring order, which is served
+            for any repository that isn't in `repos`
+        latency: seconds added to the response time of each request
+        rate_limit: number of requests allowed in each rate-limit window (None for no limit)
+        rate_limit_window: length of a rate-limit window, in seconds
+        repos: a dictionary of the stars of specific repositories, keyed by "owner/name"
+    """
+    def __init__(self, stars, latency=0.0, rate_limit=None, rate_limit_window=60, repos=None):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self.lock = threading.Lock()
+        self.window_end = 0
+        self.window_requests = 0
+        self.stats = {"requests": 0, "rate_limited": 0, "not_modified": 0, "bytes": 0}
+        self.server = None
+        self.stars = []
+        self.repos = {}
+        self.profiles = {}
+        self.add_stars(stars)
+        for repo, repo_stars in (repos or {}).items():
+            self.add_stars(repo_stars, repo)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        fake = self
+
+        class Handler(FakeGithubHandler):
+            github = fake
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def api_url(self):
+        return "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    def use_budget(self):
+        """Count a request against the rate-limit budget, and return (allowed, remaining, reset time)"""
+        with self.lock:
+            self.stats["requests"] += 1
+            if self.rate_limit is None:
+                return True, None, None
+            now = time.time()
+            if now >= self.window_end:
+                # Reset times are whole seconds, as in github's X-RateLimit-Reset header
+                self.window_end = int(now + self.rate_limit_window) + 1
+                self.window_requests = 0
+            self.window_requests += 1
+            allowed = self.window_requests <= self.rate_limit
+            if not allowed:
+                self.stats["rate_limited"] += 1
+            return allowed, max(self.rate_limit - self.window_requests, 0), self.window_end
+
+    def add_stars(self, stars, repo=None):
+        """Star a repository by more users (e.g. to test updating a cache file)"""
+        with self.lock:
+            if repo is None:
+                self.stars = self.stars + list(stars)
+            else:
+                self.repos[repo] = self.repos.get(repo, []) + list(stars)
+            self.profiles.update((profile['login'], profile) for starred_at, profile in stars)
+
+    def repo_stars(self, repo):
+        return self.repos.get(repo, self.stars)
+
+    def stargazers_page(self, page, per_page, repo=None):
+        return [{"starred_at": starred_at, "user": {"login": profile['login'], "id": profile['id']}}
+                for starred_at, profile in self.repo_stars(repo)[(page-1)*per_page:page*per_page]]
+
+    def graphql_stargazers(self, count, cursor, repo=None):
+        stars = self.repo_stars(repo)
+        start = int(cursor or 0)
+        end = min(start + count, len(stars))
+        edges = [{"starredAt": starred_at,
+                  "node": {"login": profile['login'], "databaseId": profile['id'], "company": profile['company'],
+                           "name": profile['name'], "location": profile['location'], "bio": profile['bio']}}
+                 for starred_at, profile in stars[start:end]]
+        return {"data": {"repository": {"stargazers": {
+            "pageInfo": {"endCursor": str(end), "hasNextPage": end < len(stars)}, "edges": edges}}}}
+
+
+class FakeGithubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    github = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if not self.start_request():
+            return
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path.endswith("/stargazers"):
+            repo = url.path[len("/repos/"):-len("/stargazers")]
+            page, per_page = int(query['page'][0]), int(query['per_page'][0])
+            last_page = max(1, -(-len(self.github.repo_stars(repo)) // per_page))
+            link = '<{}{}?page={}&per_page={}>; rel="last"'.format(self.github.api_url, url.path, last_page, per_page)
+            self.send_json(self.github.stargazers_page(page, per_page, repo), {"Link": link})
+        elif url.path.startswith("/users/"):
+            login = url.path[len("/users/"):]
+            if login not in self.github.profiles:
+                self.send_json({"message": "Not Found"}, status=404)
+                return
+            etag = '"{}"'.format(login)
+            if self.headers.get('If-None-Match') == etag:
+                with self.github.lock:
+                    self.github.stats["not_modified"] += 1
+                self.send_json(None, {"ETag": etag}, status=304)
+                return
+            self.send_json(self.github.profiles[login], {"ETag": etag})
+        else:
+            self.send_json({"message": "Not Found"}, status=404)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if not self.start_request():
+            return
+        variables = request['variables']
+        self.send_json(self.github.graphql_stargazers(variables['count'], variables['cursor'],
+                                                      "{}/{}".format(variables['owner'], variables['name'])))
+
+    def start_request(self):
+        """Wait for the configured latency, and reply with an error if the rate-limit budget is exhausted"""
+        time.sleep(self.github.latency)
+        allowed, remaining, reset = self.github.use_budget()
+        self.rate_limit_headers = {}
+        if remaining is not None:
+            self.rate_limit_headers = {"X-RateLimit-Limit": str(self.github.rate_limit),
+                                       "X-RateLimit-Remaining": str(remaining),
+                                       "X-RateLimit-Reset": str(reset)}
+        if not allowed:
+            self.send_json({"message": "API rate limit exceeded"}, status=403)
+        return allowed
+
+    def send_json(self, body, headers=None, status=200):
+        data = json.dumps(body).encode('utf-8') if body is not None else b""
+        self.send_response(status)
+        for name, value in dict(self.rate_limit_headers, **(headers or {})).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        with self.github.lock:
+            self.github.stats["bytes"] += len(data)
@@ -0,0 +1,263 @@
+"""Measure how the stages of the analytics scale, and save the timings as JSON.
+
+The benchmarks run on synthetic data (see synthetic.py), in a work directory which holds the
+generated gazetteer and cache files, and the outputs of the stages:
+- gazetteer: compile the metadata, build and load the index, and match locations.
+- For each cache size and format (CSV or columnar): load the starring times, classify the
+  locations, aggregate the stars history, render the plots and the map, and create a report.
+- crawl: query a fake github server (see fake_github.py) with the REST and GraphQL APIs, update
+  a cache file, and crawl several repositories in a batch.
+
+Example:
+    python benchmarks/run_benchmarks.py --sizes=10000,100000 --output=before.json
+    python benchmarks/run_benchmarks.py --sizes=10000,100000 --output=after.json --compare=before.json
+"""
+import contextlib
+import csv
+import datetime
+import json
+import os
+import platform
+import shutil
+import sys
+import time
+import warnings
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np
+import pandas as pd
+from tabulate import tabulate
+import stars_analytics
+import github_crawler
+import star_cache
+import synthetic
+from fake_github import FakeGithub
+
+
+STAGES = ["gazetteer", "load", "classify", "aggregate", "render", "report", "crawl"]
+
+
+def timed(fn, repeat=1, quiet=True):
+    """Call `fn` `repeat` times, and return the fastest wall time, all of the times and the last result"""
+    times = []
+    result = None
+    for _ in range(repeat):
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull if quiet else sys.stdout):
+            start = time.perf_counter()
+            result = fn()
+            times.append(time.perf_counter() - start)
+    return min(times), times, result
+
+
+class Results(object):
+    """Collect the timings of the stages, keyed by stage/variant (e.g. classify/100000/csv)"""
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.timings = {}
+
+    def run(self, key, fn, **extra):
+        seconds, times, result = timed(fn, self.repeat)
+        self.timings[key] = dict(seconds=seconds, runs=times, **extra)
+        print("{:<40} {:10.3f} sec".format(key, seconds))
+        return result
+
+
+def prepare_data(args):
+    cities = synthetic.generate_gazetteer(".", args.cities_per_country)
+    caches = {}
+    for size in args.sizes:
+        fname = "stars_{}.csv".format(size)
+        if args.regenerate or not os.path.exists(fname):
+            print("Generating {}".format(fname))
+            synthetic.generate_cache(fname, size, cities)
+        caches[size] = fname
+    return cities, caches
+
+
+def columnar_fname(fcache):
+    # Not the default columnar file name, so that the CSV benchmarks don't pick it up
+    return os.path.splitext(fcache)[0] + "-columnar.npz"
+
+
+def bench_gazetteer(results, caches):
+    results.run("gazetteer/compile", stars_analytics.compile_geo_index)
+    results.run("gazetteer/build-index", stars_analytics.build_geo_index)
+    geo_index = results.run("gazetteer/load-index", stars_analytics.load_geo_index)
+
+    # Match the unique locations of the smallest cache, with the reference linear scan and with the matcher
+    with open(caches[min(caches)]) as csv_file:
+        features = sorted({stars_analytics.get_location_feature(record)
+                           for record in csv.reader(csv_file)})[:2000]
+    pairs, details, matcher = geo_index['country_city_pairs'], geo_index['country_details'], geo_index['matcher']
+    for name, match in [("linear-scan", lambda feature: stars_analytics.match_country(feature, pairs, details)),
+                        ("matcher", matcher.match)]:
+        key = "gazetteer/match/" + name
+        results.run(key, lambda: [match(feature) for feature in features], locations=len(features))
+        results.timings[key]["usec_per_location"] = 1e6 * results.timings[key]["seconds"] / max(len(features), 1)
+    return geo_index
+
+
+def bench_cache(results, stages, geo_index, fcache, size, fmt, workers):
+    key = "{{}}/{}/{}".format(size, fmt)
+    if "load" in stages:
+        results.run(key.format("load"), lambda: stars_analytics.read_starring_times(fcache), rows=size)
+    if "classify" in stages:
+        results.run(key.format("classify"),
+                    lambda: stars_analytics.read_starring_history_db(
+                        stars_analytics.ClassificationCache(geo_index['matcher']), fcache, workers),
+                    rows=size, workers=workers)
+    if "aggregate" in stages:
+        for group_type in ["monthly", "weekly", "daily", "day-of-week"]:
+            results.run(key.format("aggregate/" + group_type),
+                        lambda: stars_analytics.group_by_date_df(fcache, group_type), rows=size)
+    if "render" in stages:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            countries_list, record_count, total_matches = stars_analytics.cached_query_results_summary(
+                fcache, geo_index=geo_index, workers=workers)
+        countries = stars_analytics.countries_df(countries_list, record_count, total_matches)
+        monthly = stars_analytics.group_by_date_df(fcache, "monthly")
+        os.makedirs("render", exist_ok=True)
+        results.run(key.format("render/plots"), lambda: (
+            stars_analytics.save_plot(countries, 'Country', '% extrapolated', 'Stars Per Country (%)',
+                                      os.path.join("render", "countries.png"), kind="bar"),
+            stars_analytics.save_plot(monthly, 'Month', 'New Stars', 'New stars',
+                                      os.path.join("render", "monthly.png"))))
+        results.run(key.format("render/map"), lambda: stars_analytics.draw_stars_map(
+            countries_list, total_matches, geo_index['country_coordinates'], os.path.join("render", "map.html")))
+        results.run(key.format("render/city-map"), lambda: stars_analytics.create_stars_map(
+            fcache, os.path.join("render", "city_map.html"), map_level="city"), rows=size)
+    if "report" in stages:
+        results.run(key.format("report"),
+                    lambda: stars_analytics.create_report(fcache, "report_{}_{}".format(size, fmt)), rows=size)
+
+
+def bench_crawl(results, cities, args):
+    stars = list(synthetic.generate_profiles(args.crawl_stars, cities, seed=1))
+    # The first crawl sees 90% of the stars, and the update fetches the rest
+    n_initial = len(stars) * 9 // 10
+    with FakeGithub(stars[:n_initial], args.latency, args.rate_limit, args.rate_limit_window) as github:
+        def crawl(name, fn):
+            before = dict(github.stats)
+            results.run("crawl/" + name, fn, stars=len(github.stars), latency=args.latency,
+                        workers=args.crawl_workers, rate_limit=args.rate_limit)
+            results.timings["crawl/" + name].update(
+                {stat: (github.stats[stat] - before[stat]) // results.repeat for stat in github.stats})
+
+        repo = "https://github.com/benchmark/repo"
+        crawl("rest", lambda: github_crawler.query_github(
+            "user", "token", repo, fname="crawl_rest.csv", workers=args.crawl_workers,
+            api_url_base=github.api_url, resume=False))
+        crawl("graphql", lambda: github_crawler.query_github_graphql(
+            "user", "token", repo, fname="crawl_graphql.csv", api_url_base=github.api_url, resume=False))
+        github.add_stars(stars[n_initial:])
+
+        def update():
+            # Each run updates the same (partial) cache file, which records the repository it belongs to
+            shutil.copy("crawl_rest.csv", "crawl_update.csv")
+            shutil.copy(github_crawler.repo_info_fname("crawl_rest.csv"),
+                        github_crawler.repo_info_fname("crawl_update.csv"))
+            github_crawler.update_github("user", "token", repo, fname="crawl_update.csv",
+                                         workers=args.crawl_workers, api_url_base=github.api_url)
+        crawl("update", update)
+
+        # Three repositories (60%, 30% and 10% of the stars), crawled under one rate-limit budget
+        bounds = [0, len(stars) * 6 // 10, len(stars) * 9 // 10, len(stars)]
+        batch_repos = ["benchmark/batch{}".format(i) for i in range(3)]
+        for i, batch_repo in enumerate(batch_repos):
+            github.add_stars(stars[bounds[i]:bounds[i+1]], batch_repo)
+        crawl("batch", lambda: github_crawler.query_github_batch(
+            "user", "token", ["https://github.com/" + batch_repo for batch_repo in batch_repos],
+            [star_cache.repo_cache_fname(batch_repo, "crawl_batch") for batch_repo in batch_repos],
+            workers=args.crawl_workers, api_url_base=github.api_url, resume=False))
+
+
+def environment():
+    return {"date": datetime.datetime.now().isoformat(timespec='seconds'),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__}
+
+
+def compare(timings, baseline_fname, threshold):
+    """Print the timings next to those of a previous run, and flag the regressions"""
+    with open(baseline_fname) as f:
+        baseline = json.load(f)['timings']
+    rows = []
+    for key, timing in timings.items():
+        if key not in baseline:
+            continue
+        ratio = timing['seconds'] / baseline[key]['seconds'] if baseline[key]['seconds'] > 0 else float('inf')
+        rows.append([key, baseline[key]['seconds'], timing['seconds'], ratio,
+                     "REGRESSION" if ratio > threshold else ""])
+    print(tabulate(rows, headers=["Stage", "Baseline (sec)", "Current (sec)", "Ratio", ""],
+                   tablefmt='psql', floatfmt=".3f"))
+    return sum(1 for row in rows if row[-1])
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark the stages of the star-gazers analytics on synthetic data")
+    parser.add_argument("--sizes", default="10000,100000,1000000",
+                        help="comma-separated numbers of star-gazers in the synthetic cache files")
+    parser.add_argument("--formats", default="csv,npz", help="cache formats to benchmark: csv, npz (columnar) or both")
+    parser.add_argument("--stages", default=",".join(STAGES), help="comma-separated stages to run")
+    parser.add_argument("--repeat", type=int, default=1, help="run each stage this many times, and keep the fastest")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="number of processes used to classify")
+    parser.add_argument("--cities-per-country", type=int, default=200, help="size of the synthetic gazetteer")
+    parser.add_argument("--workdir", default="benchmark_data",
+                        help="directory holding the synthetic data and the outputs (reused across runs)")
+    parser.add_argument("--regenerate", action="store_true", default=False,
+                        help="generate the synthetic cache files even if they exist")
+    parser.add_argument("--crawl-stars", type=int, default=1000, help="number of star-gazers served by the fake github")
+    parser.add_argument("--crawl-workers", type=int, default=8, help="number of concurrent workers of the crawler")
+    parser.add_argument("--latency", type=float, default=0.02, help="latency (seconds) of the fake github server")
+    parser.add_argument("--rate-limit", type=int, default=None,
+                        help="number of requests the fake github allows in each rate-limit window")
+    parser.add_argument("--rate-limit-window", type=float, default=5, help="length (seconds) of a rate-limit window")
+    parser.add_argument("-o", "--output", default="benchmark_results.json", help="file to save the timings to")
+    parser.add_argument("--compare", default=None, help="timings file of a previous run, to compare against")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="flag stages which are slower than the previous run by more than this ratio")
+    args = parser.parse_args()
+    # folium warns about the map tiles on every map
+    warnings.filterwarnings("ignore", module="folium")
+    args.sizes = [int(size) for size in args.sizes.split(",")]
+    stages = args.stages.split(",")
+    for stage in stages:
+        if stage not in STAGES:
+            raise ValueError("Unknown stage {} (choose from {})".format(stage, ", ".join(STAGES)))
+    output = os.path.abspath(args.output)
+    baseline = os.path.abspath(args.compare) if args.compare else None
+
+    os.makedirs(args.workdir, exist_ok=True)
+    os.chdir(args.workdir)
+    cities, caches = prepare_data(args)
+    results = Results(args.repeat)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        geo_index = stars_analytics.build_geo_index()
+    if "gazetteer" in stages:
+        geo_index = bench_gazetteer(results, caches)
+    cache_stages = [stage for stage in stages if stage not in ["gazetteer", "crawl"]]
+    for size, fcache in caches.items() if cache_stages else []:
+        for fmt in args.formats.split(","):
+            if fmt == "npz":
+                results.run("convert/{}".format(size),
+                            lambda: star_cache.convert_cache(fcache, columnar_fname(fcache)), rows=size)
+            bench_cache(results, cache_stages, geo_index, columnar_fname(fcache) if fmt == "npz" else fcache,
+                        size, fmt, args.workers)
+    if "crawl" in stages:
+        bench_crawl(results, cities, args)
+
+    with open(output, "w") as f:
+        json.dump({"environment": environment(), "args": vars(args), "timings": results.timings}, f, indent=2)
+    print("Saved the timings to {}".format(output))
+    if baseline is not None and compare(results.timings, baseline, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
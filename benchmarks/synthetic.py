@@ -0,0 +1,172 @@
+"""Generate synthetic geographical metadata and star-gazer caches, for the benchmarks.
+
+The files have the same formats as the downloaded metadata (see download_metadata.sh) and as
+the cache files written by the github crawler, so they can be fed to any of the commands.
+"""
+import csv
+import json
+import os
+import random
+import datetime
+
+
+# (name, capital, population, latitude, longitude)
+COUNTRIES = [
+    ("United States", "Washington", 327000000, 38, -97),
+    ("China", "Beijing", 1386000000, 35, 105),
+    ("India", "New Delhi", 1339000000, 20, 77),
+    ("Germany", "Berlin", 82700000, 51, 9),
+    ("United Kingdom", "London", 66000000, 54, -2),
+    ("France", "Paris", 67100000, 46, 2),
+    ("Brazil", "Brasilia", 209300000, -10, -55),
+    ("Canada", "Ottawa", 36700000, 60, -95),
+    ("Russia", "Moscow", 144500000, 60, 100),
+    ("Japan", "Tokyo", 126800000, 36, 138),
+    ("South Korea", "Seoul", 51500000, 37, 127.5),
+    ("Israel", "Jerusalem", 8700000, 31.5, 34.75),
+    ("Spain", "Madrid", 46600000, 40, -4),
+    ("Italy", "Rome", 60600000, 42.8, 12.8),
+    ("Netherlands", "Amsterdam", 17000000, 52.5, 5.75),
+    ("Poland", "Warsaw", 38000000, 52, 20),
+    ("Ukraine", "Kiev", 44800000, 49, 32),
+    ("Australia", "Canberra", 24600000, -27, 133),
+    ("Singapore", "Singapore", 5600000, 1.4, 103.8),
+    ("Switzerland", "Bern", 8400000, 47, 8),
+    ("Sweden", "Stockholm", 10000000, 62, 15),
+    ("Iran", "Tehran", 81200000, 32, 53),
+    ("Mexico", "Mexico City", 129200000, 23, -102),
+    ("Argentina", "Buenos Aires", 44300000, -34, -64),
+    ("Georgia", "Tbilisi", 3700000, 42, 43.5),
+    ("Jordan", "Amman", 9700000, 31, 36),
+    ("Niger", "Niamey", 21500000, 16, 8),
+    ("Nigeria", "Abuja", 190900000, 10, 8),
+    ("Chad", "N'Djamena", 14900000, 15, 19),
+    ("Ivory Coast", "Yamoussoukro", 24300000, 8, -5),
+    ("Moldova", "Chisinau", 3500000, 47, 29),
+    ("Vietnam", "Hanoi", 95500000, 16, 106),
+]
+
+SYLLABLES = ["ka", "lo", "san", "ta", "ber", "lin", "par", "is", "to", "kyo", "on", "ly", "new", "york", "ham",
+             "burg", "ch", "en", "gd", "u", "mar", "se", "ille", "vi", "en", "na", "os", "lo", "ri", "ga"]
+
+# Locations which don't name a place
+NOISE_LOCATIONS = ["Earth", "Remote", "Internet", "localhost", "127.0.0.1", "The Moon", "Everywhere", "~", "🌍"]
+
+ABBREVIATIONS = {"United States": ["USA", "U.S.A.", "CA", "NY"], "United Kingdom": ["UK", "U.K."],
+                 "China": ["PRC", "P.R.C."]}
+
+
+def gazetteer_fnames(dirname):
+    """Return the names of the metadata files: stars_analytics.GEO_SOURCES and CITY_COORDINATES_FNAME"""
+    return [os.path.join(dirname, fname) for fname in ["countries-readable.json",
+                                                       "world-cities_json.json",
+                                                       "average-latitude-longitude-countries.csv",
+                                                       "cities15000.txt"]]
+
+
+def random_city_name(rng):
+    return "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))).title()
+
+
+def generate_gazetteer(dirname, cities_per_country=200, seed=0):
+    """Write a small gazetteer: a list of countries, a list of cities, and the coordinates of both.
+
+    Return the list of city records, which generate_cache uses to create realistic locations.
+    """
+    rng = random.Random(seed)
+    os.makedirs(dirname, exist_ok=True)
+    countries_fname, cities_fname, coordinates_fname, geonames_fname = gazetteer_fnames(dirname)
+    cities = []
+    geonames = []
+    for name, capital, population, latitude, longitude in COUNTRIES:
+        subcountries = [random_city_name(rng) + " Region" for _ in range(max(cities_per_country // 20, 1))]
+        for i in range(cities_per_country):
+            geonames.append((len(cities), latitude + rng.gauss(0, 3), longitude + rng.gauss(0, 4),
+                             int(rng.paretovariate(1) * 15000)))
+            cities.append({"country": name, "name": capital if i == 0 else random_city_name(rng),
+                           "subcountry": rng.choice(subcountries + ([None] if i else [])), "geonameid": len(cities)})
+    with open(countries_fname, "w") as f:
+        json.dump([{"name": name, "capital": capital, "population": str(population)}
+                   for name, capital, population, latitude, longitude in COUNTRIES], f)
+    with open(cities_fname, "w") as f:
+        json.dump(cities, f)
+    with open(coordinates_fname, "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(["ISO 3166 Country Code", "Country", "Latitude", "Longitude"])
+        for i, (name, capital, population, latitude, longitude) in enumerate(COUNTRIES):
+            writer.writerow(["C{}".format(i), name, latitude, longitude])
+    with open(geonames_fname, "w") as f:
+        # GeoNames' tab-separated format: we only fill the ID, name, coordinates and population
+        for (geonameid, latitude, longitude, population), city in zip(geonames, cities):
+            fields = [""] * 19
+            fields[0], fields[1], fields[4], fields[5], fields[14] = (str(geonameid), city["name"],
+                                                                      "{:.5f}".format(latitude),
+                                                                      "{:.5f}".format(longitude), str(population))
+            f.write("\t".join(fields) + "\n")
+    return cities
+
+
+def random_location(rng, cities):
+    """Return a location, as github users write them (about a third of the star-gazers leave it empty)"""
+    r = rng.random()
+    if r < 0.35:
+        return None
+    if r < 0.40:
+        return rng.choice(NOISE_LOCATIONS)
+    city = rng.choice(cities)
+    r = rng.random()
+    if r < 0.35:
+        location = "{}, {}".format(city["name"], city["country"])
+    elif r < 0.55:
+        location = city["name"]
+    elif r < 0.70:
+        location = "{}, {}".format(city["name"], city["subcountry"] or city["country"])
+    elif r < 0.85:
+        location = city["country"]
+    elif city["country"] in ABBREVIATIONS:
+        location = "{}, {}".format(city["name"], rng.choice(ABBREVIATIONS[city["country"]]))
+    else:
+        location = "{}\n{}".format(city["name"], city["country"])
+    if rng.random() < 0.1:
+        location = location.lower()
+    if rng.random() < 0.02:
+        location = location.replace(", ", "，")
+    return location
+
+
+def star_times(rng, n_stars, start=datetime.datetime(2017, 1, 1), days=3*365, n_bursts=5):
+    """Return sorted starring times: a steady trickle of stars which slowly grows, and a few bursts (e.g. a release)"""
+    times = []
+    burst_days = [rng.uniform(0, days) for _ in range(n_bursts)]
+    for _ in range(n_stars):
+        if rng.random() < 0.2:
+            # Most of the stars of a burst arrive within a day or two of the announcement
+            day = rng.choice(burst_days) + abs(rng.gauss(0, 1.5))
+        else:
+            day = days * rng.random() ** 0.7
+        times.append(start + datetime.timedelta(days=min(day, days)))
+    return sorted(times)
+
+
+def generate_profiles(n_stars, cities, seed=0):
+    """Generate (starred_at, user profile) tuples, in starring order"""
+    rng = random.Random(seed)
+    for i, starred in enumerate(star_times(rng, n_stars)):
+        profile = {"login": "user{}".format(i),
+                   "id": 1000 + i,
+                   "company": rng.choice([None, None, "ACME", "@initech", "Globex Corp."]),
+                   "name": rng.choice([None, "User {}".format(i), "Ĳsbrand Ødegård {}".format(i)]),
+                   "location": random_location(rng, cities),
+                   "bio": rng.choice([None, None, "Deep learning, compilers and coffee.", "PhD student"])}
+        yield starred.strftime('%Y-%m-%dT%H:%M:%SZ'), profile
+
+
+def generate_cache(fname, n_stars, cities, seed=0):
+    """Write a cache file with `n_stars` synthetic star-gazers, in the crawler's format"""
+    with open(fname, "w") as file:
+        csv_file = csv.writer(file)
+        for starred_at, profile in generate_profiles(n_stars, cities, seed):
+            # The crawler writes the string fields as bytes (see github_crawler.get_user)
+            user_desc = {k: v.encode('utf-8') if isinstance(v, str) else v for k, v in profile.items()}
+            csv_file.writerow([user_desc['login'], user_desc['id'], user_desc['company'],
+                               user_desc['name'], user_desc['location'], user_desc['bio'], starred_at])
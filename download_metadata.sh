@@ -1,3 +1,4 @@
 wget https://raw.githubusercontent.com/albertyw/avenews/master/old/data/average-latitude-longitude-countries.csv
 wget https://raw.githubusercontent.com/lorey/list-of-countries/master/json/countries-readable.json
 wget https://pkgstore.datahub.io/core/world-cities/world-cities_json/data/5b3dd46ad10990bca47b04b4739a02ba/world-cities_json.json
+wget https://download.geonames.org/export/dump/cities15000.zip && unzip -o cities15000.zip
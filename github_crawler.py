@@ -0,0 +1,782 @@
+import json
+import csv
+import os
+import datetime
+import urllib.parse
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from star_cache import decode_csv_field, repo_owner_name, complete_rows_size
+from metrics import METRICS
+
+
+class GithubSession(requests.Session):
+    """A session that schedules its requests according to github's rate-limit budget.
+
+    Github reports the remaining request budget, and the time at which it is reset, in the
+    X-RateLimit-* headers of every response.  We use them to:
+    - Pace the requests evenly over the time left until the reset, once the budget runs low.
+    - Sleep until the reset time, when the budget is exhausted.
+    - Retry server errors (5xx), connection errors and secondary rate-limit responses with an
+      exponential backoff (or after Retry-After seconds, when github tells us how long to wait).
+    The session is shared by the crawler's worker threads.
+    """
+    def __init__(self, max_retries=5, low_budget=0.1):
+        super(GithubSession, self).__init__()
+        self.max_retries = max_retries
+        # Start pacing the requests when less than this fraction of the budget is left
+        self.low_budget = low_budget
+        self.lock = threading.Lock()
+        self.limit = None
+        self.remaining = None
+        self.reset = None
+        self.next_request_time = 0
+        self.n_requests = 0
+        self.start_time = time.time()
+
+    def request(self, method, url, *args, **kwargs):
+        backoff = 1
+        for attempt in range(self.max_retries + 1):
+            self.wait_for_budget()
+            start = time.perf_counter()
+            try:
+                r = super(GithubSession, self).request(method, url, *args, **kwargs)
+            except requests.ConnectionError as e:
+                METRICS.record_request(method, url, "error", time.perf_counter() - start, 0)
+                if attempt == self.max_retries:
+                    raise
+                print("{} {} failed ({}): retrying in {:.0f} seconds".format(method, url, e, backoff))
+                time.sleep(backoff)
+                backoff *= 2
+                continue
+            METRICS.record_request(method, url, r.status_code, time.perf_counter() - start, len(r.content))
+            self.update_budget(r)
+            delay = self.retry_delay(r, backoff)
+            if delay is None or attempt == self.max_retries:
+                return r
+            print("{} {} returned {}: retrying in {:.0f} seconds".format(method, url, r.status_code, delay))
+            time.sleep(delay)
+            backoff *= 2
+        return r
+
+    def wait_for_budget(self):
+        with self.lock:
+            now = time.time()
+            delay = 0
+            if self.remaining is not None and self.reset > now:
+                if self.remaining <= 0:
+                    delay = self.reset - now + 1
+                elif self.remaining < self.limit * self.low_budget:
+                    start = max(now, self.next_request_time)
+                    self.next_request_time = start + (self.reset - now) / self.remaining
+                    delay = start - now
+            if self.remaining is not None:
+                # Account for the requests which are in flight
+                self.remaining -= 1
+        if delay > 0:
+            if delay > 60:
+                print("Rate-limit budget exhausted: sleeping {:.0f} seconds until it is reset".format(delay))
+            with METRICS.stage("rate-limit-wait"):
+                time.sleep(delay)
+
+    def update_budget(self, r):
+        with self.lock:
+            self.n_requests += 1
+            if 'X-RateLimit-Remaining' not in r.headers:
+                return
+            remaining = int(r.headers['X-RateLimit-Remaining'])
+            reset = int(r.headers.get('X-RateLimit-Reset', 0))
+            self.limit = int(r.headers.get('X-RateLimit-Limit', remaining))
+            if reset != self.reset:
+                # A new rate-limit window
+                self.reset = reset
+                self.remaining = remaining
+            else:
+                # Responses can arrive out of order, so the lowest budget is the most recent
+                self.remaining = min(self.remaining, remaining)
+
+    def retry_delay(self, r, backoff):
+        """Return the number of seconds to wait before retrying a failed request, or None if it should not be retried"""
+        if r.status_code >= 500:
+            return backoff
+        if r.status_code in (403, 429):
+            if 'Retry-After' in r.headers:
+                return float(r.headers['Retry-After'])
+            if r.headers.get('X-RateLimit-Remaining') == '0':
+                return max(int(r.headers.get('X-RateLimit-Reset', 0)) - time.time(), 0) + 1
+            if "secondary rate limit" in r.text.lower():
+                # Github asks to wait at least a minute before retrying
+                return max(backoff, 60)
+        return None
+
+    def report(self):
+        elapsed = time.time() - self.start_time
+        print("Requests: {} ({:.1f}/sec)  Rate-limit budget: {}/{}".format(
+            self.n_requests, self.n_requests / elapsed if elapsed > 0 else 0, self.remaining, self.limit))
+
+
+def create_session(github_user, github_pw, https_proxy=None, workers=1):
+    """Create an HTTP session which is shared by all of the crawler's requests.
+
+    The session keeps its connections alive, so we don't pay for a new TCP+TLS handshake
+    on every request.  We size the connection pool to the number of workers, otherwise
+    the workers would fight over a small pool and connections would be discarded.
+    """
+    session = GithubSession()
+    session.auth = (github_user, github_pw)
+    session.headers.update({'Accept': 'application/vnd.github.v3.star+json'})
+    if https_proxy is not None:
+        session.proxies.update({"https": https_proxy})
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(workers, 1))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def repo_api_url(git_repo_url, api_url_base):
+    """Convert a repository's web URL to its API URL"""
+    return api_url_base + "/repos/" + repo_owner_name(git_repo_url)
+
+
+def get_stargazers_page(session, git_repo_url_base, page, recs_per_page):
+    """Return the list of star records in the specified page, or None if the request failed."""
+    git_repo_url = git_repo_url_base + "/stargazers?page={}&per_page={}"
+    r = session.get(git_repo_url.format(page, recs_per_page))
+    if not r.ok:
+        return None
+    with METRICS.stage("parse-json"):
+        return json.loads(r.text or r.content)
+
+
+class UserCache(object):
+    """An on-disk store of github user profiles, keyed by login, which is shared by all crawls.
+
+    Many repositories share star-gazers, so we keep the profiles we download in an SQLite
+    database.  A profile that is younger than `ttl_days` is used as-is; an older profile is
+    revalidated with a conditional request (If-None-Match), which github answers with a cheap
+    "304 Not Modified" if the profile did not change.
+    The cache is accessed by the crawler's worker threads, so all access is serialized.
+    """
+    def __init__(self, fname="github_users.db", ttl_days=30):
+        self.ttl = ttl_days * 24 * 60 * 60
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(fname, check_same_thread=False)
+        # WAL keeps the per-profile commits cheap
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS users "
+                        "(login TEXT PRIMARY KEY, etag TEXT, fetched_at REAL, profile TEXT)")
+        self.db.commit()
+        self.stats = {"hits": 0, "revalidated": 0, "misses": 0}
+
+    def lookup(self, login):
+        """Return (profile, etag, is_fresh) for a cached login, or None"""
+        with self.lock:
+            row = self.db.execute("SELECT etag, fetched_at, profile FROM users WHERE login=?",
+                                  (login,)).fetchone()
+        if row is None:
+            return None
+        etag, fetched_at, profile = row
+        return json.loads(profile), etag, time.time() - fetched_at < self.ttl
+
+    @METRICS.stage("user-cache-write")
+    def store(self, login, profile, etag):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?)",
+                            (login, etag, time.time(), json.dumps(profile)))
+            self.db.commit()
+
+    @METRICS.stage("user-cache-write")
+    def touch(self, login):
+        """Mark a cached profile as fresh, after github told us it was not modified"""
+        with self.lock:
+            self.db.execute("UPDATE users SET fetched_at=? WHERE login=?", (time.time(), login))
+            self.db.commit()
+
+    def count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def close(self):
+        print("User cache: {hits} hits, {revalidated} revalidated, {misses} misses".format(**self.stats))
+        self.db.close()
+
+
+def fetch_user_profile(session, api_url_base, login, user_cache=None):
+    """Return the profile of a github user, using the user cache when it is available"""
+    cached = user_cache.lookup(login) if user_cache is not None else None
+    headers = {}
+    if cached is not None:
+        profile, etag, is_fresh = cached
+        if is_fresh:
+            user_cache.count("hits")
+            return profile
+        if etag:
+            headers['If-None-Match'] = etag
+    r = session.get(api_url_base + "/users/" + login, headers=headers)
+    if r.status_code == 304 and cached is not None:
+        user_cache.count("revalidated")
+        user_cache.touch(login)
+        return cached[0]
+    if not r.ok:
+        raise ValueError("GET {}/users/ failed".format(api_url_base))
+    with METRICS.stage("parse-json"):
+        profile = json.loads(r.text or r.content)
+    if user_cache is not None:
+        user_cache.count("misses")
+        user_cache.store(login, profile, r.headers.get('ETag'))
+    return profile
+
+
+def get_user(session, api_url_base, login, user_cache=None):
+    user_desc = dict(fetch_user_profile(session, api_url_base, login, user_cache))
+    for k,v in user_desc.items():
+        if isinstance(v, str):
+            user_desc[k] = v.encode('utf-8')
+    return user_desc
+
+
+@METRICS.stage("read-cache")
+def read_cached_stars(fname):
+    """Return a dictionary mapping the logins which are already written to the cache file, to their starring time"""
+    stars = {}
+    if not os.path.exists(fname):
+        return stars
+    with open(fname) as csv_file:
+        for record in csv.reader(csv_file):
+            if record:
+                stars[decode_csv_field(record[0])] = record[6]
+    return stars
+
+
+class CacheWriter(object):
+    """Append star records to a cache file, and sync them to disk in groups.
+
+    Syncing each row costs about as much as fetching it, so the rows are buffered and synced
+    together (group commit):
+    - every `sync_rows` rows, and/or every `sync_seconds` seconds, if given;
+    - otherwise, once per completed page.
+    The crawler's checkpoint must never get ahead of the rows on disk, so `on_sync(page)` is called
+    after each sync, with the last page that was completed (see end_page) before the sync.
+    """
+    def __init__(self, fname, mode="a", sync_rows=None, sync_seconds=None, on_sync=None):
+        if sync_rows is not None and sync_rows < 1:
+            raise ValueError("sync_rows must be at least 1 (got {})".format(sync_rows))
+        self.fname = fname
+        if mode == "a":
+            repair_cache_file(fname)
+        self.file = open(fname, mode)
+        self.csv_file = csv.writer(self.file)
+        self.sync_rows = sync_rows
+        self.sync_seconds = sync_seconds
+        self.on_sync = on_sync
+        self.pending_rows = 0
+        self.last_sync_time = time.time()
+        self.completed_page = None
+        self.synced_page = None
+        self.n_syncs = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def writerow(self, row):
+        self.csv_file.writerow(row)
+        self.pending_rows += 1
+        if (self.sync_rows is not None and self.pending_rows >= self.sync_rows) or \
+                (self.sync_seconds is not None and time.time() - self.last_sync_time >= self.sync_seconds):
+            self.sync()
+
+    def end_page(self, page=None):
+        """Mark the rows of a page as written, and sync them if it's time.
+
+        `page` is the number of the page to checkpoint, or None if it shouldn't be checkpointed
+        (e.g. the last, partial, page).
+        """
+        if page is not None:
+            self.completed_page = page
+        if (self.sync_rows is None and self.sync_seconds is None) or \
+                (self.sync_seconds is not None and time.time() - self.last_sync_time >= self.sync_seconds):
+            self.sync()
+
+    def sync(self):
+        if self.pending_rows:
+            with METRICS.stage("fsync"):
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            self.n_syncs += 1
+        self.pending_rows = 0
+        self.last_sync_time = time.time()
+        if self.on_sync is not None and self.completed_page is not None and self.completed_page != self.synced_page:
+            self.on_sync(self.completed_page)
+        self.synced_page = self.completed_page
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+
+def repair_cache_file(fname):
+    """Remove a partially written row from the end of a cache file (e.g. after a crash)"""
+    if not os.path.exists(fname):
+        return
+    with open(fname, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        end = complete_rows_size(f)
+        if end < size:
+            f.truncate(end)
+            f.flush()
+            os.fsync(f.fileno())
+            print("Removed a partially written row ({} bytes) from the end of {}".format(size - end, fname))
+
+
+def checkpoint_fname(fname):
+    return fname + ".checkpoint"
+
+
+def load_checkpoint(fname, git_repo_url, recs_per_page, n_cached):
+    """Return the last stargazers page which was completely written to the cache file.
+
+    Page numbers are only meaningful for the same repository and page size, so we refuse to
+    resume from a checkpoint that was created for a different crawl.  A checkpoint is also
+    discarded when the cache file holds fewer than its pages' `n_cached` rows (e.g. the cache
+    file was deleted in order to start over), and the crawl starts from the first page.
+    """
+    if not os.path.exists(checkpoint_fname(fname)):
+        return 0
+    with open(checkpoint_fname(fname)) as f:
+        checkpoint = json.load(f)
+    if n_cached < checkpoint['last_page'] * checkpoint['recs_per_page']:
+        print("Discarding {}: {} has {} stars, but the checkpoint is after page {}".format(
+            checkpoint_fname(fname), fname, n_cached, checkpoint['last_page']))
+        os.remove(checkpoint_fname(fname))
+        return 0
+    if checkpoint['repo'] != git_repo_url or checkpoint['recs_per_page'] != recs_per_page:
+        raise ValueError("Checkpoint {} belongs to a different crawl ({})".format(
+            checkpoint_fname(fname), checkpoint['repo']))
+    return checkpoint['last_page']
+
+
+@METRICS.stage("checkpoint")
+def save_checkpoint(fname, git_repo_url, recs_per_page, last_page):
+    # Write to a temporary file and rename it, so that a crash never leaves a corrupt checkpoint
+    tmp_fname = checkpoint_fname(fname) + ".tmp"
+    with open(tmp_fname, "w") as f:
+        json.dump({'repo': git_repo_url, 'recs_per_page': recs_per_page, 'last_page': last_page}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_fname, checkpoint_fname(fname))
+
+
+def repo_info_fname(fname):
+    return fname + ".repo"
+
+
+def load_repo_info(fname):
+    """Return the repository ("owner/name") and API recorded for a cache file, or None if there is no record.
+
+    Caches whose crawl started before the record was kept may still have a checkpoint, which
+    names the repository of a REST crawl.
+    """
+    if os.path.exists(repo_info_fname(fname)):
+        with open(repo_info_fname(fname)) as f:
+            return json.load(f)
+    if os.path.exists(checkpoint_fname(fname)):
+        with open(checkpoint_fname(fname)) as f:
+            checkpoint = json.load(f)
+        return {'repo': checkpoint['repo'].split("/repos/", 1)[-1].lower(), 'api': "rest"}
+    return None
+
+
+def check_cache_repo(fname, git_repo_url):
+    """Refuse to append to a cache file which holds the star-gazers of another repository.
+
+    A cache file remembers the repository (and the API) it was crawled with, in a file next to
+    it.  We also refuse when a non-empty cache file has no such record, because we can't tell
+    where its star-gazers came from.  Either API may resume the crawl of the other, since both
+    skip the logins which are already in the cache file.
+    """
+    if not os.path.exists(fname) or os.path.getsize(fname) == 0:
+        return
+    info = load_repo_info(fname)
+    if info is None:
+        raise ValueError("{} doesn't record which repository it caches: use update --adopt to claim it for {}, "
+                         "--restart to query it from scratch, or choose another cache file".format(fname, git_repo_url))
+    repo = repo_owner_name(git_repo_url).lower()
+    if info['repo'] != repo:
+        raise ValueError("{} caches the star-gazers of {}, not of {}: use --restart to overwrite it, "
+                         "or choose another cache file".format(fname, info['repo'], repo))
+
+
+def save_repo_info(fname, git_repo_url, api):
+    tmp_fname = repo_info_fname(fname) + ".tmp"
+    with open(tmp_fname, "w") as f:
+        json.dump({'repo': repo_owner_name(git_repo_url).lower(), 'api': api}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_fname, repo_info_fname(fname))
+
+
+def get_last_page(session, git_repo_url_base, recs_per_page):
+    """Return the number of the last stargazers page, using the pagination links of the first page"""
+    git_repo_url = git_repo_url_base + "/stargazers?page=1&per_page={}"
+    r = session.get(git_repo_url.format(recs_per_page))
+    if not r.ok:
+        raise ValueError("GET {} failed".format(git_repo_url_base + "/stargazers"))
+    if 'last' not in r.links:
+        # A single page (or no stars at all)
+        return 1
+    query = urllib.parse.urlparse(r.links['last']['url']).query
+    return int(urllib.parse.parse_qs(query)['page'][0])
+
+
+GRAPHQL_STARGAZERS_QUERY = """
+query($owner: String!, $name: String!, $count: Int!, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    stargazers(first: $count, after: $cursor, orderBy: {field: STARRED_AT, direction: ASC}) {
+      pageInfo { endCursor hasNextPage }
+      edges {
+        starredAt
+        node { login databaseId company name location bio }
+      }
+    }
+  }
+}
+"""
+
+
+def iter_graphql_stargazers(session, api_url_base, git_repo_url, recs_per_page):
+    """Generate pages of (starred_at, user profile) tuples, using github's GraphQL API.
+
+    Each request returns up to 100 stargazers together with the profile fields that we cache,
+    so we don't need a /users request per star-gazer.
+    """
+    owner, name = repo_owner_name(git_repo_url).split("/")[:2]
+    cursor = None
+    while True:
+        r = session.post(api_url_base + "/graphql",
+                         json={'query': GRAPHQL_STARGAZERS_QUERY,
+                               'variables': {'owner': owner, 'name': name,
+                                             'count': recs_per_page, 'cursor': cursor}},
+                         headers={'Accept': 'application/json'})
+        if not r.ok:
+            raise ValueError("POST {}/graphql failed ({})".format(api_url_base, r.status_code))
+        with METRICS.stage("parse-json"):
+            response = json.loads(r.text or r.content)
+        if response.get('errors'):
+            raise ValueError("GraphQL query failed: {}".format(response['errors'][0].get('message')))
+        stargazers = response['data']['repository']['stargazers']
+        # Rename the GraphQL fields, so that the profiles look like the ones returned by /users
+        yield [(edge['starredAt'], {'login': edge['node']['login'],
+                                    'id': edge['node']['databaseId'],
+                                    'company': edge['node']['company'],
+                                    'name': edge['node']['name'],
+                                    'location': edge['node']['location'],
+                                    'bio': edge['node']['bio']})
+               for edge in stargazers['edges']]
+        if not stargazers['pageInfo']['hasNextPage']:
+            break
+        cursor = stargazers['pageInfo']['endCursor']
+
+
+def iter_stargazers_pages(pool, session, git_repo_url_base, recs_per_page, pages_ahead, first_page=1):
+    """Generate (page, star records) tuples in page order, while prefetching the next pages.
+
+    We don't know how many pages there are, so we keep a window of `pages_ahead` outstanding
+    page requests and stop at the first empty (or failed) page.  A few requests past the last
+    page are wasted, but that's a small price for never waiting on a page fetch.
+    """
+    page = first_page
+    pending = deque()
+    while True:
+        while len(pending) < pages_ahead:
+            pending.append((page, pool.submit(get_stargazers_page, session, git_repo_url_base,
+                                              page, recs_per_page)))
+            page += 1
+        next_page, future = pending.popleft()
+        stars_records = future.result()
+        if stars_records is None:
+            print("Done or Error")
+            break
+        if len(stars_records) <= 0:
+            print("Done")
+            break
+        yield next_page, stars_records
+    for _, future in pending:
+        future.cancel()
+
+
+def write_stars(pool, session, api_url_base, stars_records, writer, cnt_stars, page, user_cache=None):
+    """Fetch the profiles of the star-gazers in `stars_records`, and append them to the cache file in order"""
+    # Queue all of the user requests before we block on the first one
+    user_futures = [pool.submit(get_user, session, api_url_base, star['user']['login'], user_cache)
+                    for star in stars_records]
+    nstars = len(stars_records)
+    for star in range(nstars):
+        print("-" * 50 + str(cnt_stars+star) + " (page:" + str(page) + ") " + "-" * 50)
+        print(stars_records[star])
+        login = stars_records[star]['user']['login']
+        starred_at = stars_records[star]['starred_at']
+        starred = datetime.datetime.strptime(starred_at, '%Y-%m-%dT%H:%M:%SZ')
+        print(login, starred.year, starred.day, starred.month)
+
+        with METRICS.stage("wait-for-profile"):
+            user_desc = user_futures[star].result()
+        print(user_desc['login'], user_desc['id'], user_desc['company'],
+              user_desc['name'], user_desc['location'], user_desc['bio'], starred_at)
+        writer.writerow([user_desc['login'], user_desc['id'], user_desc['company'],
+                         user_desc['name'], user_desc['location'], user_desc['bio'], starred_at])
+    return nstars
+
+
+def query_github(github_user, github_pw, git_repo_url_base, https_proxy=None, fname="star_gazers.csv",
+                 workers=1, api_url_base="https://api.github.com", resume=True, user_cache=None,
+                 sync_rows=None, sync_seconds=None):
+    """Download the star-gazers of a github repository, and cache them in a CSV file.
+
+    Stargazer pages and user-profile requests are fetched concurrently by a pool of `workers`
+    threads, over a single pooled session.  The rows are written in the order the stars appear
+    in the stargazers list, regardless of the order in which the requests complete.
+
+    When a `user_cache` is given, user profiles are looked up in it before querying github.
+    When `resume` is True and the cache file exists, the crawl continues after the last page
+    recorded in the checkpoint file, and only stars whose login is not already in the cache are
+    appended.  A crash or an error therefore only loses the work done since the last sync of the
+    cache file (see CacheWriter for `sync_rows` and `sync_seconds`).
+    """
+    session = create_session(github_user, github_pw, https_proxy, workers)
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        cnt_stars = sum(crawl_stargazers(pool, session, git_repo_url_base, fname, api_url_base, resume, user_cache,
+                                         sync_rows, sync_seconds))
+    print("Total: ", cnt_stars)
+    session.report()
+
+
+def crawl_stargazers(pool, session, git_repo_url_base, fname, api_url_base, resume=True, user_cache=None,
+                     sync_rows=None, sync_seconds=None):
+    """Crawl the star-gazers of a repository with the REST API (see query_github).
+
+    This is a generator, which yields the number of stars written after each page, so that
+    several crawls can take turns (see query_github_batch).
+    """
+    recs_per_page = 50
+    cnt_stars = 0
+    git_repo_url = git_repo_url_base
+    git_repo_url_base = repo_api_url(git_repo_url_base, api_url_base)
+    if resume:
+        repair_cache_file(fname)
+        check_cache_repo(fname, git_repo_url)
+        written_logins = set(read_cached_stars(fname))
+        last_page = load_checkpoint(fname, git_repo_url_base, recs_per_page, len(written_logins))
+    else:
+        last_page = 0
+        written_logins = set()
+        if os.path.exists(checkpoint_fname(fname)):
+            os.remove(checkpoint_fname(fname))
+    if written_logins:
+        print("Resuming after page {} ({} stars already cached)".format(last_page, len(written_logins)))
+    save_repo_info(fname, git_repo_url, "rest")
+    writer = CacheWriter(fname, "a" if resume else "w", sync_rows, sync_seconds,
+                         on_sync=lambda page: save_checkpoint(fname, git_repo_url_base, recs_per_page, page))
+    with writer:
+        pages = iter_stargazers_pages(pool, session, git_repo_url_base, recs_per_page,
+                                      pages_ahead=2, first_page=last_page+1)
+        for page, page_records in pages:
+            # Stars of a partially written page are already in the cache, so skip them
+            stars_records = [star for star in page_records if star['user']['login'] not in written_logins]
+            nstars = write_stars(pool, session, api_url_base, stars_records, writer, cnt_stars, page, user_cache)
+            written_logins.update(star['user']['login'] for star in stars_records)
+            cnt_stars += nstars
+            # The last page is only checkpointed once it is full, because new stars are added to it
+            writer.end_page(page if len(page_records) == recs_per_page else None)
+            session.report()
+            yield nstars
+
+
+def query_github_graphql(github_user, github_pw, git_repo_url_base, https_proxy=None, fname="star_gazers.csv",
+                         api_url_base="https://api.github.com", resume=True, user_cache=None,
+                         sync_rows=None, sync_seconds=None):
+    """Download the star-gazers of a github repository using the GraphQL API, and cache them in a CSV file.
+
+    This writes the same CSV records as query_github, but needs about 1/100 of the requests.
+    The stargazer pages are cheap, so instead of keeping a checkpoint, a resumed crawl pages
+    through all of the stargazers again and appends only the logins missing from the cache.
+    As with query_github, a cache file of another repository is never appended to.
+    The downloaded profiles are also stored in the `user_cache`, for the benefit of REST crawls.
+    """
+    session = create_session(github_user, github_pw, https_proxy)
+    cnt_stars = sum(crawl_stargazers_graphql(session, git_repo_url_base, fname, api_url_base, resume, user_cache,
+                                             sync_rows, sync_seconds))
+    print("Total: ", cnt_stars)
+    session.report()
+
+
+def crawl_stargazers_graphql(session, git_repo_url_base, fname, api_url_base, resume=True, user_cache=None,
+                             sync_rows=None, sync_seconds=None):
+    """Crawl the star-gazers of a repository with the GraphQL API (see query_github_graphql).
+
+    Like crawl_stargazers, this yields the number of stars written after each page.
+    """
+    recs_per_page = 100
+    cnt_stars = 0
+    if resume:
+        repair_cache_file(fname)
+        check_cache_repo(fname, git_repo_url_base)
+    written_logins = set(read_cached_stars(fname)) if resume else set()
+    # The pages of a REST checkpoint won't match the cache file once we wrote to it
+    if os.path.exists(checkpoint_fname(fname)):
+        os.remove(checkpoint_fname(fname))
+    if written_logins:
+        print("Resuming ({} stars already cached)".format(len(written_logins)))
+    save_repo_info(fname, git_repo_url_base, "graphql")
+    with CacheWriter(fname, "a" if resume else "w", sync_rows, sync_seconds) as writer:
+        for page, stars in enumerate(iter_graphql_stargazers(session, api_url_base, git_repo_url_base,
+                                                             recs_per_page), 1):
+            nstars = 0
+            for starred_at, profile in stars:
+                if profile['login'] in written_logins:
+                    continue
+                if user_cache is not None:
+                    user_cache.store(profile['login'], profile, None)
+                user_desc = {k: v.encode('utf-8') if isinstance(v, str) else v for k, v in profile.items()}
+                writer.writerow([user_desc['login'], user_desc['id'], user_desc['company'],
+                                 user_desc['name'], user_desc['location'], user_desc['bio'], starred_at])
+                written_logins.add(profile['login'])
+                nstars += 1
+            writer.end_page()
+            cnt_stars += nstars
+            print("Page {}: {} stars".format(page, cnt_stars))
+            session.report()
+            yield nstars
+
+
+def update_github(github_user, github_pw, git_repo_url_base, https_proxy=None, fname="star_gazers.csv",
+                  workers=1, api_url_base="https://api.github.com", user_cache=None, sync_rows=None, sync_seconds=None,
+                  restart=False, adopt=False):
+    """Append to an existing cache file only the star-gazers that were added since it was created.
+
+    Github returns the stargazers ordered by the starring time, so the new stars are all on the
+    trailing pages.  We walk backwards from the last page until we reach a star that is older
+    than the newest star in the cache, and then fetch the profiles of the new star-gazers only.
+    The cache file must belong to the same repository (see check_cache_repo), unless `restart`
+    is True, in which case all of the star-gazers are queried again.  A cache file which doesn't
+    record its repository (e.g. one written by an older version) is claimed for this repository
+    when `adopt` is True.
+    """
+    session = create_session(github_user, github_pw, https_proxy, workers)
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        cnt_stars = sum(update_stargazers(pool, session, git_repo_url_base, fname, api_url_base, user_cache,
+                                          sync_rows, sync_seconds, restart, adopt))
+    print("Total: ", cnt_stars)
+    session.report()
+
+
+def update_stargazers(pool, session, git_repo_url_base, fname, api_url_base, user_cache=None,
+                      sync_rows=None, sync_seconds=None, restart=False, adopt=False):
+    """Append the new star-gazers of a repository to its cache file (see update_github).
+
+    This yields the number of stars written: once, or after each page if the cache file is empty
+    (or `restart` is True) and all of the star-gazers are crawled.
+    """
+    if restart:
+        yield from crawl_stargazers(pool, session, git_repo_url_base, fname, api_url_base, resume=False,
+                                    user_cache=user_cache, sync_rows=sync_rows, sync_seconds=sync_seconds)
+        return
+    repair_cache_file(fname)
+    if adopt and os.path.exists(fname) and load_repo_info(fname) is None:
+        print("Adopting {} as the cache file of {}".format(fname, repo_owner_name(git_repo_url_base)))
+        save_repo_info(fname, git_repo_url_base, "rest")
+    check_cache_repo(fname, git_repo_url_base)
+    cached_stars = read_cached_stars(fname)
+    if not cached_stars:
+        print("{} is empty or missing: querying all of the star-gazers".format(fname))
+        yield from crawl_stargazers(pool, session, git_repo_url_base, fname, api_url_base,
+                                    user_cache=user_cache, sync_rows=sync_rows, sync_seconds=sync_seconds)
+        return
+    # The new stars are fetched with the REST API, but the cache keeps the API it was crawled with
+    api = load_repo_info(fname)['api']
+    git_repo_url = git_repo_url_base
+    newest_starred_at = max(cached_stars.values())
+    recs_per_page = 50
+    git_repo_url_base = repo_api_url(git_repo_url_base, api_url_base)
+    page = get_last_page(session, git_repo_url_base, recs_per_page)
+    new_stars = []
+    while page >= 1:
+        page_records = get_stargazers_page(session, git_repo_url_base, page, recs_per_page)
+        if page_records is None:
+            raise ValueError("GET {} failed".format(git_repo_url_base + "/stargazers"))
+        new_stars = [star for star in page_records
+                     if star['starred_at'] >= newest_starred_at and
+                     star['user']['login'] not in cached_stars] + new_stars
+        if not page_records or page_records[0]['starred_at'] < newest_starred_at:
+            break
+        page -= 1
+    print("Found {} new stars since {}".format(len(new_stars), newest_starred_at))
+
+    with CacheWriter(fname, "a", sync_rows, sync_seconds) as writer:
+        nstars = write_stars(pool, session, api_url_base, new_stars, writer, len(cached_stars), page, user_cache)
+    save_repo_info(fname, git_repo_url, api)
+    yield nstars
+
+
+def query_github_batch(github_user, github_pw, git_repo_urls, fnames, https_proxy=None, workers=1,
+                       api_url_base="https://api.github.com", api="rest", update=False, resume=True,
+                       user_cache=None, sync_rows=None, sync_seconds=None, adopt=False):
+    """Crawl (or update) several repositories, each into its own cache file, under one request budget.
+
+    All of the crawls share one session, which paces the requests according to the (per-user)
+    rate-limit budget, and one pool of workers.  The crawls take turns, a page at a time, so a
+    repository with many stars doesn't hold back the others, and all of them make progress
+    while the budget lasts.  A crawl which fails (e.g. for a repository that doesn't exist) is
+    reported and dropped, and the others go on.
+    Return a dictionary of the number of stars written for each repository, and a dictionary of
+    the exceptions of the failed crawls.
+    """
+    if len(git_repo_urls) != len(fnames):
+        raise ValueError("Got {} repositories, but {} cache files".format(len(git_repo_urls), len(fnames)))
+    if len(set(fnames)) != len(fnames):
+        raise ValueError("Two repositories would be crawled into the same cache file: {}".format(
+            ", ".join(fname for fname in fnames if fnames.count(fname) > 1)))
+    session = create_session(github_user, github_pw, https_proxy, workers)
+    totals = {}
+    errors = {}
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        crawls = deque()
+        for git_repo_url, fname in zip(git_repo_urls, fnames):
+            os.makedirs(os.path.dirname(fname) or ".", exist_ok=True)
+            if update:
+                crawl = update_stargazers(pool, session, git_repo_url, fname, api_url_base, user_cache,
+                                          sync_rows, sync_seconds, restart=not resume, adopt=adopt)
+            elif api == "graphql":
+                crawl = crawl_stargazers_graphql(session, git_repo_url, fname, api_url_base, resume, user_cache,
+                                                 sync_rows, sync_seconds)
+            else:
+                crawl = crawl_stargazers(pool, session, git_repo_url, fname, api_url_base, resume, user_cache,
+                                         sync_rows, sync_seconds)
+            crawls.append((git_repo_url, crawl))
+            totals[git_repo_url] = 0
+        while crawls:
+            git_repo_url, crawl = crawls.popleft()
+            try:
+                totals[git_repo_url] += next(crawl)
+            except StopIteration:
+                print("Finished {} ({} stars)".format(git_repo_url, totals[git_repo_url]))
+                continue
+            except Exception as e:
+                print("Failed {} after {} stars: {!r}".format(git_repo_url, totals[git_repo_url], e))
+                errors[git_repo_url] = e
+                continue
+            crawls.append((git_repo_url, crawl))
+
+    for (git_repo_url, cnt_stars), fname in zip(totals.items(), fnames):
+        print("{}: {} stars => {}{}".format(git_repo_url, cnt_stars, fname,
+                                           " (failed: {})".format(errors[git_repo_url]) if git_repo_url in errors
+                                           else ""))
+    session.report()
+    return totals, errors
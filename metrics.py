@@ -0,0 +1,144 @@
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+class Metrics(object):
+    """Record the wall time, call count and peak memory of each stage of a command, and the HTTP requests.
+
+    Recording is off until enable() is called, and then a stage costs a couple of microseconds, plus
+    the overhead of tracemalloc, which tracks the peak memory of the stages.  Stages can be nested,
+    and each stage reports the peak memory allocated while it (and the stages it called) ran.
+    The memory of a stage is only tracked on the main thread, because the peak is global to the
+    process; the stages of the crawler's worker threads record their time and call count only.
+    Work done in child processes (e.g. parallel classification) is not traced.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.requests = {}
+        self.memory_stack = []
+        self.start_time = None
+
+    def enable(self, trace_memory=True):
+        self.enabled = True
+        self.start_time = time.time()
+        if trace_memory:
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name):
+        """Record a stage of the pipeline.  This can also be used as a function decorator."""
+        if not self.enabled:
+            yield
+            return
+        track_memory = tracemalloc.is_tracing() and threading.current_thread() is threading.main_thread()
+        if track_memory:
+            self.enter_memory_frame()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            peak = self.exit_memory_frame() if track_memory else None
+            with self.lock:
+                stats = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0, "max_seconds": 0.0,
+                                                      "peak_memory": None})
+                stats["calls"] += 1
+                stats["seconds"] += elapsed
+                stats["max_seconds"] = max(stats["max_seconds"], elapsed)
+                if peak is not None:
+                    stats["peak_memory"] = max(stats["peak_memory"] or 0, peak)
+
+    def enter_memory_frame(self):
+        current, peak = tracemalloc.get_traced_memory()
+        if self.memory_stack:
+            # Fold the peak reached so far into the enclosing stage, before we reset it
+            self.memory_stack[-1] = max(self.memory_stack[-1], peak)
+        tracemalloc.reset_peak()
+        self.memory_stack.append(current)
+
+    def exit_memory_frame(self):
+        current, peak = tracemalloc.get_traced_memory()
+        peak = max(self.memory_stack.pop(), peak)
+        if self.memory_stack:
+            self.memory_stack[-1] = max(self.memory_stack[-1], peak)
+        tracemalloc.reset_peak()
+        return peak
+
+    def record_request(self, method, url, status, seconds, nbytes):
+        """Record an HTTP request, by the kind of API endpoint it used"""
+        if not self.enabled:
+            return
+        with self.lock:
+            stats = self.requests.setdefault(endpoint_kind(method, url), {"latencies": [], "bytes": 0, "status": {}})
+            stats["latencies"].append(seconds)
+            stats["bytes"] += nbytes
+            stats["status"][str(status)] = stats["status"].get(str(status), 0) + 1
+
+    def summary(self, command=None):
+        requests = {kind: requests_summary(stats) for kind, stats in self.requests.items()}
+        if self.requests:
+            requests["total"] = requests_summary({
+                "latencies": [latency for stats in self.requests.values() for latency in stats["latencies"]],
+                "bytes": sum(stats["bytes"] for stats in self.requests.values()),
+                "status": {}})
+        max_rss = None
+        if resource is not None:
+            # ru_maxrss is in kilobytes on Linux, and in bytes on macOS
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+        return {"command": command,
+                "argv": sys.argv,
+                "wall_seconds": time.time() - self.start_time,
+                "max_rss": max_rss,
+                "stages": self.stages,
+                "requests": requests}
+
+    def save(self, fname, command=None):
+        tmp_fname = fname + ".tmp"
+        with open(tmp_fname, "w") as f:
+            json.dump(self.summary(command), f, indent=2)
+        os.replace(tmp_fname, fname)
+        print("Saved the metrics to {}".format(fname))
+
+
+def endpoint_kind(method, url):
+    if "/graphql" in url:
+        return "graphql"
+    if "/stargazers" in url:
+        return "stargazers"
+    if "/users/" in url:
+        return "users"
+    return method.lower()
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(int(len(sorted_values) * p / 100), len(sorted_values) - 1)]
+
+
+def requests_summary(stats):
+    latencies = sorted(stats["latencies"])
+    summary = {"count": len(latencies), "bytes": stats["bytes"]}
+    if stats["status"]:
+        summary["status"] = stats["status"]
+    if latencies:
+        summary["latency"] = {"mean": sum(latencies) / len(latencies),
+                              "p50": percentile(latencies, 50),
+                              "p90": percentile(latencies, 90),
+                              "p99": percentile(latencies, 99),
+                              "max": latencies[-1]}
+    return summary
+
+
+# The metrics of the current process, which are shared by all of the modules
+METRICS = Metrics()
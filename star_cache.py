@@ -0,0 +1,160 @@
+import csv
+import ast
+import os
+import numpy as np
+from metrics import METRICS
+
+
+# The columns of the CSV cache file written by the github crawler
+CACHE_COLUMNS = ['login', 'id', 'company', 'name', 'location', 'bio', 'starred_at']
+TEXT_COLUMNS = ['login', 'company', 'name', 'location', 'bio']
+COLUMNAR_CACHE_VERSION = 1
+
+
+def decode_csv_field(field):
+    """Undo the bytes-repr encoding of string fields in the cache file (e.g. "b'netaz'" => "netaz")"""
+    if field.startswith(("b'", 'b"')):
+        if '\\' not in field:
+            # A bytes-repr without escapes is plain ASCII, so we don't need to evaluate it
+            return field[2:-1]
+        return ast.literal_eval(field).decode('utf-8')
+    return field
+
+
+def normalize_location(location):
+    """Clean a location string, and return the location feature used for classification"""
+    location_features = location.lower()
+    location_features = location_features.replace('\n', ' ')
+    location_features = location_features.replace(',', ' ')
+    location_features = location_features.replace('，', ' ')
+    return location_features
+
+
+def parse_starred_at(starred_at):
+    """Parse a sequence of github timestamps (e.g. 2018-11-01T09:46:51Z) in bulk, into a datetime64 array"""
+    # numpy doesn't accept the UTC designator
+    return np.array([timestamp.rstrip('Z') for timestamp in starred_at], dtype='datetime64[s]')
+
+
+def complete_rows_size(f):
+    """Return the size of the complete rows at the start of a cache file, which is open in binary mode.
+
+    The string fields of the cache are written as escaped bytes literals, so a raw newline only
+    appears at the end of a row: anything after the last newline is a row which is still being
+    written (or which a crash cut short).
+    """
+    size = f.seek(0, os.SEEK_END)
+    end = size
+    while end > 0:
+        start = max(end - (1 << 16), 0)
+        f.seek(start)
+        newline = f.read(end - start).rfind(b"\n")
+        if newline >= 0:
+            return start + newline + 1
+        end = start
+    return 0
+
+
+def complete_lines(f):
+    """Generate the lines of a cache file which is open in text mode, without a partially written
+    last row (see complete_rows_size)"""
+    for line in f:
+        if line.endswith("\n"):
+            yield line
+
+
+def repo_owner_name(git_repo_url):
+    """Return the "owner/name" part of a repository's web URL (e.g. https://github.com/NervanaSystems/distiller)"""
+    return git_repo_url.split("github.com/", 1)[-1].strip("/")
+
+
+def repo_cache_fname(git_repo_url, cache_dir="."):
+    """Return the name of a repository's cache file in a batch crawl: <cache_dir>/<owner>_<name>.csv"""
+    return os.path.join(cache_dir, repo_owner_name(git_repo_url).replace("/", "_") + ".csv")
+
+
+def cache_name(fcache):
+    """The name of a cache in reports and queries: its file name, without the directory and extension"""
+    return os.path.splitext(os.path.basename(fcache))[0]
+
+
+def columnar_cache_fname(fcache):
+    """Return the name of the columnar cache file which is kept alongside a CSV cache file"""
+    return os.path.splitext(fcache)[0] + ".npz"
+
+
+def pack_strings(strings):
+    """Pack a list of strings into one UTF-8 buffer and an array of offsets into it.
+
+    Numpy's fixed-width string arrays are padded to the longest string, which would make a
+    column of free text (e.g. bio) huge.
+    """
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def unpack_strings(data, offsets):
+    blob = data.tobytes()
+    return [blob[offsets[i]:offsets[i+1]].decode('utf-8') for i in range(len(offsets) - 1)]
+
+
+@METRICS.stage("convert")
+def convert_cache(fcache, columnar_fname=None):
+    """Convert a CSV cache file to a columnar cache file (a numpy .npz archive).
+
+    The CSV file is parsed only once, here.  In the columnar file:
+    - `id` is int64, and `starred_at` is datetime64.
+    - The text columns are decoded from their bytes-repr, and stored as `<column>_data` and
+      `<column>_offsets` (see pack_strings).
+    - The normalized location feature is dictionary-encoded: `location_feature_values` holds
+      the unique features and `location_feature_codes` the index of each record's feature.
+      Many star-gazers share a location, so the features can be classified once per value.
+    """
+    if columnar_fname is None:
+        columnar_fname = columnar_cache_fname(fcache)
+    columns = {column: [] for column in CACHE_COLUMNS}
+    with open(fcache) as csv_file:
+        # A crawl may be appending to the cache file, so leave out a partially written last row
+        for record in csv.reader(complete_lines(csv_file), delimiter=','):
+            for column, field in zip(CACHE_COLUMNS, record):
+                columns[column].append(field)
+
+    arrays = {'version': np.array(COLUMNAR_CACHE_VERSION)}
+    for column in TEXT_COLUMNS:
+        columns[column] = [decode_csv_field(field) for field in columns[column]]
+        arrays[column + '_data'], arrays[column + '_offsets'] = pack_strings(columns[column])
+    arrays['id'] = np.array(columns['id'], dtype=np.int64)
+    arrays['starred_at'] = parse_starred_at(columns['starred_at'])
+    feature_codes = {}
+    arrays['location_feature_codes'] = np.array(
+        [feature_codes.setdefault(normalize_location(location), len(feature_codes))
+         for location in columns['location']], dtype=np.int32)
+    arrays['location_feature_values'] = np.array(list(feature_codes), dtype=str)
+
+    # np.savez appends .npz to names that don't end with it, so write to a file object
+    tmp_fname = columnar_fname + ".tmp"
+    with open(tmp_fname, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_fname, columnar_fname)
+    print("Converted {} records from {} to {}".format(len(arrays['id']), fcache, columnar_fname))
+
+
+def load_columnar_cache(fcache):
+    """Return the columnar cache of a cache file, or None if we should read the CSV file.
+
+    `fcache` can name the columnar file itself, or a CSV file.  In the latter case, the columnar
+    file alongside it is used only if it is at least as new as the CSV file.
+    The returned archive loads each column lazily, when it is first accessed.
+    """
+    if fcache.endswith(".npz"):
+        columnar_fname = fcache
+    else:
+        columnar_fname = columnar_cache_fname(fcache)
+        if not os.path.exists(columnar_fname) or os.path.getmtime(columnar_fname) < os.path.getmtime(fcache):
+            return None
+    columns = np.load(columnar_fname)
+    if columns['version'] != COLUMNAR_CACHE_VERSION:
+        raise ValueError("{} has an unsupported format: convert {} again".format(columnar_fname, fcache))
+    return columns
@@ -1,69 +1,28 @@
 import json
 import csv
 import os
-from argparse import ArgumentParser
-from tabulate import tabulate
-import folium
-import pandas as pd
-import datetime
-import requests
-import matplotlib
-matplotlib.use('TkAgg')
-import matplotlib.pyplot as plt
-
-
-def query_github(github_user, github_pw, git_repo_url_base, https_proxy=None, fname="star_gazers.csv"):
-    headers = {'Accept': 'application/vnd.github.v3.star+json'}
-    proxyDict = {"https": https_proxy}
-    recs_per_page = 50
-    page = 1
-    cnt_stars = 0
-    git_repo_url_base = git_repo_url_base.replace("github.com", "api.github.com/repos")
-    with open(fname, "w") as file:
-        csv_file = csv.writer(file)
-        while True:
-            git_repo_url = git_repo_url_base + "/stargazers?page={}&per_page={}"
-            r = requests.get(git_repo_url.format(page, recs_per_page),
-                             auth=(github_user, github_pw),
-                             headers=headers, proxies=proxyDict)
-            if not r.ok:
-                print("Done or Error")
-                break
-            stars_records = json.loads(r.text or r.content)
-            nstars = len(stars_records)
-            if nstars <= 0:
-                print("Done")
-                break
-            for star in range(nstars):
-                print("-" * 50 + str(cnt_stars+star) + " (page:" + str(page) + ") " + "-" * 50)
-                print(stars_records[star])
-                user = stars_records[star]['user']
-                login = user['login']
-                starred_at = stars_records[star]['starred_at']
-                starred = datetime.datetime.strptime(starred_at, '%Y-%m-%dT%H:%M:%SZ')
-                print(login, starred.year, starred.day, starred.month)
-
-                r = requests.get("https://api.github.com/users/" + login,
-                                 auth=(github_user, github_pw),
-                                 headers=headers, proxies=proxyDict)
-                if not r.ok:
-                    raise ValueError("GET https://api.github.com/users/ failed")
-                user_desc = json.loads(r.text or r.content)
-                for k,v in user_desc.items():
-                    if isinstance(v, str):
-                        user_desc[k] = v.encode('utf-8')
-                print(user_desc['login'], user_desc['id'], user_desc['company'],
-                      user_desc['name'], user_desc['location'], user_desc['bio'], starred_at)
-                csv_file.writerow([user_desc['login'], user_desc['id'], user_desc['company'],
-                                   user_desc['name'], user_desc['location'], user_desc['bio'], starred_at])
-                file.flush()
-                os.fsync(file.fileno())
-            page += 1
-            cnt_stars += nstars
-
-    print("Total: ", cnt_stars)
-
-
+from argparse import ArgumentParser, ArgumentTypeError
+import numpy as np
+import calendar
+import hashlib
+import itertools
+import heapq
+import zlib
+import pickle
+import io
+import html
+import math
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+# pandas, matplotlib, folium, tabulate and requests (which the crawler uses) take a long time to import,
+# so they are only imported by the functions that need them, and the commands start quickly.
+from metrics import METRICS
+from star_cache import decode_csv_field, normalize_location, convert_cache, load_columnar_cache, \
+    columnar_cache_fname, parse_starred_at, unpack_strings, CACHE_COLUMNS, repo_owner_name, repo_cache_fname, \
+    cache_name, complete_lines, complete_rows_size
+
+
+@METRICS.stage("parse-gazetteer")
 def get_countries_metadata(fname="countries-readable.json"):
     """Read a database file containing information about different countries.
 
@@ -85,6 +44,7 @@ def get_countries_metadata(fname="countries-readable.json"):
     return details
 
 
+@METRICS.stage("parse-gazetteer")
 def read_cities_db(fname="world-cities_json.json"):
     """Read a database file containing names of cities from different countries.
 
@@ -94,7 +54,7 @@ def read_cities_db(fname="world-cities_json.json"):
         world_cities = json.load(f)
 
     country_city_pairs = set()
-    processed_sub_countries = []
+    processed_sub_countries = set()
     for city_record in world_cities:
         country = city_record['country'].lower()
         if country == "south korea":
@@ -105,7 +65,7 @@ def read_cities_db(fname="world-cities_json.json"):
         subcountry = city_record['subcountry'].lower() if city_record['subcountry'] is not None else None
         if subcountry is not None and subcountry not in processed_sub_countries:
             # Add (subcountry, country)
-            processed_sub_countries.append(subcountry)
+            processed_sub_countries.add(subcountry)
             country_city_pairs.add((country, subcountry))
 
     # People use these abbreviations, so we can't ignore them
@@ -116,26 +76,25 @@ def read_cities_db(fname="world-cities_json.json"):
     country_city_pairs.add(('china', 'prc'))
     country_city_pairs.add(('china', 'p.r.c.'))
 
-    # Sort by longest city name first, because later we want to do long-string-match
-    country_city_pairs = sorted(country_city_pairs, key=lambda pair: len(pair[1]), reverse=True)
+    # Sort by longest city name first, because later we want to do long-string-match.
+    # Names of the same length are sorted alphabetically, so that the order (which is used for
+    # breaking ties) doesn't depend on the iteration order of the set.
+    country_city_pairs = sorted(country_city_pairs, key=lambda pair: (-len(pair[1]), pair))
     return country_city_pairs
 
 
 def get_location_feature(record):
     """Clean the star record, and return the location feature.
     """
-    location_features = record[4]
-    location_features = location_features.lower()
-    location_features = location_features.replace('\n', ' ')
-    location_features = location_features.replace(',', ' ')
-    location_features = location_features.replace('，', ' ')
-    return location_features
+    return normalize_location(decode_csv_field(record[4]))
 
 
 def match_country(raw_location_feature, country_city_pairs, country_details):
     """Find the country which is most-likely home of this github star-gazer.
 
     We perform a simple search for the names of countries and cities.
+    This scans all of the (country, city) pairs, so it is slow.  CountryMatcher returns the
+    same results, and should be used when classifying many records.
 
     Return:
         matched country, matched city, string describing how we matched (for debug)
@@ -159,7 +118,15 @@ def match_country(raw_location_feature, country_city_pairs, country_details):
             # Matching a country name is a very strong indication.
             matches.append((country, country))
             matches.append((country, country))
+    return resolve_matches(matches, country_details)
+
 
+def resolve_matches(matches, country_details):
+    """Choose the most-likely country from the list of (country, city) matches of a location.
+
+    Return:
+        matched country, matched city, string describing how we matched (for debug)
+    """
     if len(matches) == 0:
         return None, None, "No match found"
     if len(matches) == 1:
@@ -210,80 +177,468 @@ def match_country(raw_location_feature, country_city_pairs, country_details):
             "Resolved ambiguity by population " + str(matches))
 
 
+class CountryMatcher(object):
+    """Match location strings against all of the city and country names at once.
+
+    match_country tests every (country, city) pair against each location, which makes the
+    classification O(records x cities).  Here we compile all of the names into an Aho-Corasick
+    automaton once, and then find all of the names contained in a location in a single pass
+    over its characters.  The matches are then filtered and ordered exactly as in
+    match_country, so both return the same results.
+    """
+    def __init__(self, country_city_pairs, country_details):
+        self.country_city_pairs = country_city_pairs
+        self.country_details = country_details
+        self._signature = None
+        # For each city name, the indices of its pairs in country_city_pairs
+        self.city_pairs = {}
+        for i, (country, city) in enumerate(country_city_pairs):
+            self.city_pairs.setdefault(city, []).append(i)
+        self.country_order = {country: i for i, country in enumerate(country_details.keys())}
+        names = set(self.city_pairs) | set(self.country_order)
+        # An empty name is contained in every string
+        self.always_found = [name for name in names if name == ""]
+
+        # The automaton's trie: goto[node] maps a character to the next node, and out[node] lists
+        # the names which end at this node (or at any of its suffixes).
+        self.goto = [{}]
+        out = [[]]
+        for name in names:
+            node = 0
+            for ch in name:
+                next_node = self.goto[node].get(ch)
+                if next_node is None:
+                    next_node = len(self.goto)
+                    self.goto[node][ch] = next_node
+                    self.goto.append({})
+                    out.append([])
+                node = next_node
+            if name:
+                out[node].append(name)
+
+        # Compute the failure links in BFS order, so that a node's failure target is always
+        # processed before the node itself
+        self.fail = [0] * len(self.goto)
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self.goto[node].items():
+                queue.append(child)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[child] = self.goto[f].get(ch, 0)
+                out[child] = out[child] + out[self.fail[child]]
+        self.out = [tuple(names_at_node) if names_at_node else None for names_at_node in out]
+
+    @classmethod
+    def from_state(cls, state):
+        """Recreate a matcher from the attributes of a compiled matcher (see build_geo_index)"""
+        matcher = cls.__new__(cls)
+        matcher.__dict__.update(state)
+        return matcher
+
+    def signature(self):
+        """Return a digest of the geographical metadata used by this matcher"""
+        if self._signature is None:
+            metadata = json.dumps([self.country_city_pairs, sorted(self.country_details.items())])
+            self._signature = hashlib.sha1(metadata.encode('utf-8')).hexdigest()
+        return self._signature
+
+    def find_names(self, raw_location_feature):
+        """Return the set of city and country names which are substrings of the location"""
+        found = set(self.always_found)
+        goto, fail, out = self.goto, self.fail, self.out
+        node = 0
+        for ch in raw_location_feature:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node] is not None:
+                found.update(out[node])
+        return found
+
+    def match(self, raw_location_feature):
+        """Same as match_country(raw_location_feature, country_city_pairs, country_details)"""
+        found = self.find_names(raw_location_feature)
+        matches = []
+        city_names = [name for name in found if name in self.city_pairs]
+        if city_names:
+            # match_country keeps the first matching pair, and the following ones of the same length
+            first_name = min(city_names, key=lambda name: self.city_pairs[name][0])
+            pair_indices = sorted(i for name in city_names if len(name) == len(first_name)
+                                  for i in self.city_pairs[name])
+            matches = [self.country_city_pairs[i] for i in pair_indices]
+        for country in sorted((name for name in found if name in self.country_order),
+                              key=self.country_order.get):
+            matches.append((country, country))
+            matches.append((country, country))
+        return resolve_matches(matches, self.country_details)
+
+
+class ClassificationCache(object):
+    """Memoize the classification of location strings.
+
+    Many star-gazers share the same location (or have no location at all), so we classify each
+    unique location feature only once.  The results can be saved to a JSON file and reused by
+    later runs, and by runs on other repositories.  The file records the signature of the
+    geographical metadata, and is ignored if the metadata has changed since it was saved.
+    """
+    def __init__(self, matcher, fname=None):
+        self.matcher = matcher
+        self.fname = fname
+        self.results = {}
+        self.hits = 0
+        self.misses = 0
+        if fname is not None and os.path.exists(fname):
+            with open(fname) as f:
+                saved = json.load(f)
+            if saved['signature'] == matcher.signature():
+                self.results = {feature: tuple(result) for feature, result in saved['results'].items()}
+            else:
+                print("Ignoring {}: it was created with different geographical metadata".format(fname))
+
+    def match(self, raw_location_feature):
+        try:
+            result = self.results[raw_location_feature]
+            self.hits += 1
+        except KeyError:
+            result = self.matcher.match(raw_location_feature)
+            self.results[raw_location_feature] = result
+            self.misses += 1
+        return result
+
+    @METRICS.stage("save-geo-cache")
+    def save(self):
+        if self.fname is None:
+            return
+        tmp_fname = self.fname + ".tmp"
+        with open(tmp_fname, "w") as f:
+            json.dump({'signature': self.matcher.signature(), 'results': self.results}, f)
+        os.replace(tmp_fname, self.fname)
+
+
+# The geographical metadata files downloaded by download_metadata.sh, and the index compiled from them
+GEO_SOURCES = ["countries-readable.json",
+               "world-cities_json.json",
+               "average-latitude-longitude-countries.csv"]
+GEO_INDEX_FNAME = "geo_index.pickle"
+# GeoNames' table of cities, which has the coordinates of the cities (optional: only the city-level map uses it)
+CITY_COORDINATES_FNAME = "cities15000.txt"
+
+
+def file_checksum(fname):
+    sha1 = hashlib.sha1()
+    with open(fname, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+@METRICS.stage("compile-geo-index")
+def compile_geo_index():
+    """Parse the geographical metadata files and compile the country matcher"""
+    country_details = get_countries_metadata(GEO_SOURCES[0])
+    country_city_pairs = read_cities_db(GEO_SOURCES[1])
+    matcher = CountryMatcher(country_city_pairs, country_details)
+    matcher.signature()
+    sources = GEO_SOURCES
+    place_coordinates = {}
+    if os.path.exists(CITY_COORDINATES_FNAME):
+        sources = GEO_SOURCES + [CITY_COORDINATES_FNAME]
+        place_coordinates = read_places_coordinates(GEO_SOURCES[1], CITY_COORDINATES_FNAME)
+    return {'checksums': {fname: file_checksum(fname) for fname in sources},
+            'country_details': country_details,
+            'country_city_pairs': country_city_pairs,
+            'country_coordinates': read_countries_coordinates(GEO_SOURCES[2]),
+            'place_coordinates': place_coordinates,
+            'matcher': matcher}
+
+
+def build_geo_index(index_fname=GEO_INDEX_FNAME):
+    """Compile the geographical metadata into a single index file, which loads much faster than the sources"""
+    geo_index = compile_geo_index()
+    # Only pickle built-in types, so that loading the index doesn't depend on where this module is imported from
+    with open(index_fname, "wb") as f:
+        pickle.dump(dict(geo_index, matcher=vars(geo_index['matcher'])), f, protocol=pickle.HIGHEST_PROTOCOL)
+    print("Created geographical index {}".format(index_fname))
+    return geo_index
+
+
+@METRICS.stage("load-geo-index")
+def load_geo_index(index_fname=GEO_INDEX_FNAME):
+    """Load the geographical index created by build-index.
+
+    The index is stamped with the checksums of the metadata files it was compiled from.  If it
+    is missing, or the metadata files have changed since it was built, we compile the metadata
+    in memory instead.
+    """
+    if not os.path.exists(index_fname):
+        print("No geographical index found: run build-index to speed this up")
+        return compile_geo_index()
+    with open(index_fname, "rb") as f:
+        geo_index = pickle.load(f)
+    for fname, checksum in geo_index['checksums'].items():
+        if os.path.exists(fname) and file_checksum(fname) != checksum:
+            print("{} changed since {} was built: run build-index to update it".format(fname, index_fname))
+            return compile_geo_index()
+    if os.path.exists(CITY_COORDINATES_FNAME) and CITY_COORDINATES_FNAME not in geo_index['checksums']:
+        print("{} was added since {} was built: run build-index to update it".format(CITY_COORDINATES_FNAME,
+                                                                                     index_fname))
+        return compile_geo_index()
+    geo_index['matcher'] = CountryMatcher.from_state(geo_index['matcher'])
+    return geo_index
+
+
 # Use this flag to debug the parsing of star-gazer country-of-origin decision.
 # Set this DEBUG_COUNTRY to the name of a particual country (all small caps) and
 # you will see how and why it made its classification decision.
 DEBUG_COUNTRY = None
 #DEBUG_COUNTRY = "brazil"
 
+# By default we only count the star-gazers of each country, so that the memory we use doesn't grow with the
+# size of the cache.  Set DEBUG_SAMPLES to keep this number of example records (their index and location
+# feature) for each country.  The examples are chosen by a hash of the login, so they are the same in every run.
+DEBUG_SAMPLES = 0
+
+
+def sample_key(login):
+    """Return a deterministic, pseudo-random sampling key for a star-gazer"""
+    return zlib.crc32(login.encode('utf-8'))
+
+
+def add_sample(country_stats, samples, key, record, raw_location_feature):
+    """Keep the `samples` records with the smallest sampling keys (a bottom-k sample).
+
+    Bottom-k samples can be merged, so the samples of a parallel run are the same as those of
+    a serial run.  The sample is kept as a heap of negated keys, whose top is the largest key.
+    """
+    reservoir = country_stats.setdefault("samples", [])
+    heapq.heappush(reservoir, (-key, -record, raw_location_feature))
+    if len(reservoir) > samples:
+        heapq.heappop(reservoir)
+
+
+def finalize_samples(countries_stats):
+    """Replace the sample heaps by lists of the sampled records, and their location features, in order"""
+    for country_stats in countries_stats.values():
+        reservoir = sorted(country_stats.pop("samples", []), key=lambda sample: -sample[1])
+        if reservoir:
+            country_stats["records"] = [-record for key, record, raw_location_feature in reservoir]
+            country_stats["debug"] = [raw_location_feature for key, record, raw_location_feature in reservoir]
+    return countries_stats
+
 
-def read_starring_history_db(country_city_pairs, country_details, fcache):
+@METRICS.stage("classify")
+def read_starring_history_db(matcher, fcache, workers=1, samples=None):
+    """Count the star-gazers from each country.
+
+    The cache is streamed, and only the counters are kept, unless `samples` (by default,
+    DEBUG_SAMPLES) asks to also keep some example records of each country.
+
+    Return:
+        a dictionary mapping each country to {"count": number of records}, with "records" and
+        "debug" lists of the sampled record indices and location features when sampling,
+        the number of records in the cache
+    """
+    if samples is None:
+        samples = DEBUG_SAMPLES
+    columns = load_columnar_cache(fcache)
+    if columns is not None:
+        countries_stats, record_count = read_columnar_starring_history_db(matcher, columns, samples)
+    elif workers > 1:
+        countries_stats, record_count = read_starring_history_db_parallel(matcher, fcache, workers, samples)
+    else:
+        with open(fcache) as csv_file:
+            csv_reader = csv.reader(csv_file, delimiter=',')
+            countries_stats, record_count = classify_records(matcher, csv_reader, samples)
+    return finalize_samples(countries_stats), record_count
+
+
+def classify_records(matcher, records, samples=0):
+    """Classify the location of each record, and count the matches of each country"""
     countries_stats = {}
-    with open(fcache) as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-        record_count = 0
-        for record in csv_reader:
-            raw_location_feature = get_location_feature(record)
-            matched_country, matched_str, reason = match_country(raw_location_feature,
-                                                                 country_city_pairs,
-                                                                 country_details)
-            if matched_country is not None:
-                if matched_country == DEBUG_COUNTRY:
-                    print("Detected {} in: {}  matched: {}  reason: {}".format(matched_country, raw_location_feature,
-                                                                               matched_str, reason))
-                try:
-                    countries_stats[matched_country]["count"] += 1
-                    countries_stats[matched_country]["records"].append(record_count)
-                    countries_stats[matched_country]["debug"].append(raw_location_feature)
-                except KeyError:
-                    countries_stats[matched_country] = {"count": 1,
-                                                        "records": [record_count],
-                                                        "debug": [raw_location_feature]}
-            record_count += 1
-        return countries_stats, record_count
-
-
-def cached_query_results_summary(fcache):
-    country_details = get_countries_metadata()
-    country_city_pairs = read_cities_db()
-    countries_stats, record_count = read_starring_history_db(country_city_pairs, country_details, fcache)
+    record_count = 0
+    for record in records:
+        raw_location_feature = get_location_feature(record)
+        matched_country, matched_str, reason = matcher.match(raw_location_feature)
+        if matched_country is not None:
+            if matched_country == DEBUG_COUNTRY:
+                print("Detected {} in: {}  matched: {}  reason: {}".format(matched_country, raw_location_feature,
+                                                                           matched_str, reason))
+            try:
+                country_stats = countries_stats[matched_country]
+                country_stats["count"] += 1
+            except KeyError:
+                country_stats = countries_stats[matched_country] = {"count": 1}
+            if samples:
+                add_sample(country_stats, samples, sample_key(decode_csv_field(record[0])),
+                           record_count, raw_location_feature)
+        record_count += 1
+    return countries_stats, record_count
+
+
+# The classification state of each worker process (see read_starring_history_db_parallel)
+_worker_matcher = None
+_worker_known_features = None
+
+
+def init_classification_worker(matcher_state, known_results):
+    global _worker_matcher, _worker_known_features
+    _worker_matcher = ClassificationCache(CountryMatcher.from_state(matcher_state))
+    _worker_matcher.results = dict(known_results)
+    _worker_known_features = set(known_results)
+
+
+def read_chunk_lines(f, start, end):
+    """Generate the lines which start within the byte range [start, end) of a file opened in binary mode.
+
+    The string fields of the cache are written as bytes-reprs, so a record never spans
+    more than one line.
+    """
+    if start > 0:
+        # Skip the line which started in the previous chunk
+        f.seek(start - 1)
+        f.readline()
+    while f.tell() < end:
+        line = f.readline()
+        if not line:
+            break
+        yield line.decode('utf-8')
+
+
+def classify_chunk(fcache, start, end, samples):
+    hits, misses = _worker_matcher.hits, _worker_matcher.misses
+    with open(fcache, "rb") as f:
+        countries_stats, record_count = classify_records(_worker_matcher,
+                                                         csv.reader(read_chunk_lines(f, start, end)), samples)
+    new_results = {feature: result for feature, result in _worker_matcher.results.items()
+                   if feature not in _worker_known_features}
+    _worker_known_features.update(new_results)
+    return countries_stats, record_count, _worker_matcher.hits - hits, _worker_matcher.misses - misses, new_results
+
+
+def read_starring_history_db_parallel(matcher, fcache, workers, samples=0):
+    """Same as read_starring_history_db, using a pool of `workers` processes.
+
+    The cache file is split into byte-range chunks, which are classified in parallel.  The
+    compiled matcher is sent to each worker once, when the worker starts.  The results of the
+    chunks are merged in the order of the chunks, so they are identical to a serial run.
+    `matcher` is a ClassificationCache, which collects the classifications made by the workers.
+    """
+    size = os.path.getsize(fcache)
+    # More chunks than workers, to balance the load
+    n_chunks = workers * 4
+    boundaries = [(size * i // n_chunks, size * (i + 1) // n_chunks) for i in range(n_chunks)]
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_classification_worker,
+                             initargs=(vars(matcher.matcher), matcher.results)) as pool:
+        chunks = list(pool.map(classify_chunk, [fcache] * n_chunks,
+                               [start for start, end in boundaries], [end for start, end in boundaries],
+                               [samples] * n_chunks))
+
+    countries_stats = {}
+    record_count = 0
+    for chunk_stats, chunk_record_count, hits, misses, new_results in chunks:
+        for country, info in chunk_stats.items():
+            merged = countries_stats.setdefault(country, {"count": 0})
+            merged["count"] += info["count"]
+            for key, record, raw_location_feature in info.get("samples", []):
+                add_sample(merged, samples, -key, record_count - record, raw_location_feature)
+        record_count += chunk_record_count
+        matcher.hits += hits
+        matcher.misses += misses
+        matcher.results.update(new_results)
+    return countries_stats, record_count
+
+
+def read_columnar_starring_history_db(matcher, columns, samples=0):
+    """Same as read_starring_history_db, for a columnar cache.
+
+    The location features are dictionary-encoded, so we only classify each unique feature, and
+    then count the records of each country with bulk array operations.
+    """
+    feature_values = columns['location_feature_values']
+    feature_codes = columns['location_feature_codes']
+    feature_counts = np.bincount(feature_codes, minlength=len(feature_values))
+    countries_stats = {}
+    # The features are numbered by their first appearance, so the countries are added in the
+    # order of their first record, as when reading the CSV file
+    feature_country = np.full(len(feature_values), -1)
+    countries = []
+    for code, raw_location_feature in enumerate(feature_values.tolist()):
+        matched_country, matched_str, reason = matcher.match(raw_location_feature)
+        if matched_country is not None:
+            if matched_country == DEBUG_COUNTRY:
+                print("Detected {} in: {}  matched: {}  reason: {}".format(matched_country, raw_location_feature,
+                                                                           matched_str, reason))
+            if matched_country not in countries_stats:
+                countries_stats[matched_country] = {"count": 0, "index": len(countries)}
+                countries.append(matched_country)
+            countries_stats[matched_country]["count"] += int(feature_counts[code])
+            feature_country[code] = countries_stats[matched_country]["index"]
+
+    if samples:
+        keys = np.array([sample_key(login) for login in unpack_strings(columns['login_data'],
+                                                                        columns['login_offsets'])],
+                        dtype=np.int64)
+        record_country = feature_country[feature_codes]
+        for i, country in enumerate(countries):
+            records = np.flatnonzero(record_country == i)
+            for record in records[np.lexsort((records, keys[records]))[:samples]].tolist():
+                add_sample(countries_stats[country], samples, int(keys[record]), record,
+                           str(feature_values[feature_codes[record]]))
+    for country_stats in countries_stats.values():
+        del country_stats["index"]
+    return countries_stats, len(feature_codes)
+
+
+def cached_query_results_summary(fcache, geo_cache=None, geo_index=None, workers=1):
+    if geo_index is None:
+        geo_index = load_geo_index()
+    matcher = ClassificationCache(geo_index['matcher'], geo_cache)
+    countries_stats, record_count = read_starring_history_db(matcher, fcache, workers)
+    matcher.save()
     print("\nSummary:")
     print("Total: ", record_count)
+    print("Location cache: {} hits, {} misses".format(matcher.hits, matcher.misses))
     total_matches = 0
     for country_name, country_match_info in countries_stats.items():
         cnt = country_match_info["count"]
         total_matches += cnt
     print("total_matches = ", total_matches)
 
-    verbose = False
-    if verbose:
+    if DEBUG_SAMPLES:
         print(json.dumps(countries_stats, indent=4))
 
     countries_list = sorted(countries_stats.items(), key=lambda kv: kv[1]["count"], reverse=True)
     return countries_list, record_count, total_matches
 
 
-def cached_query_results_df(fcache):
-    countries_list, record_count, total_matches = cached_query_results_summary(fcache)
-    df = pd.DataFrame(columns=['Country', 'Instances', '%', '% extrapolated'])
-    for country_stats in countries_list:
-        country = country_stats[0]
-        cnt_instances = country_stats[1]["count"]
-        df.loc[len(df.index)] = ([country,
-                                  cnt_instances,
-                                  100 * cnt_instances/record_count,
-                                  100 * cnt_instances/total_matches])
-    return df
+@METRICS.stage("dataframe")
+def countries_df(countries_list, record_count, total_matches):
+    import pandas as pd
+    instances = np.array([country_stats[1]["count"] for country_stats in countries_list])
+    return pd.DataFrame({'Country': [country_stats[0] for country_stats in countries_list],
+                         'Instances': instances,
+                         '%': 100 * instances/record_count,
+                         '% extrapolated': 100 * instances/total_matches})
+
+
+def cached_query_results_df(fcache, geo_cache=None, workers=1):
+    countries_list, record_count, total_matches = cached_query_results_summary(fcache, geo_cache, workers=workers)
+    return countries_df(countries_list, record_count, total_matches)
 
 
-def print_stars_per_country(fcache):
-    df = cached_query_results_df(fcache)
+def print_stars_per_country(fcache, geo_cache=None, workers=1):
+    from tabulate import tabulate
+    df = cached_query_results_df(fcache, geo_cache, workers)
     t = tabulate(df, headers='keys', tablefmt='psql', floatfmt=".5f")
     print(t)
 
 
-def plot_stars_per_country(fcache):
-    df = cached_query_results_df(fcache)
+def plot_stars_per_country(fcache, geo_cache=None, workers=1):
+    import matplotlib.pyplot as plt
+    df = cached_query_results_df(fcache, geo_cache, workers)
     plt.figure(figsize=(20, 10))
     plt.bar(df['Country'], df['% extrapolated'], width = 1/1.5)
     plt.title('Stars Per Country (%)')
@@ -292,10 +647,13 @@ def plot_stars_per_country(fcache):
     plt.show()
 
 
-def create_stars_map(fcache, html_name='stars_map.html'):
-    # Source https://github.com/albertyw/avenews/blob/master/old/data/average-latitude-longitude-countries.csv
+@METRICS.stage("parse-gazetteer")
+def read_countries_coordinates(fname="average-latitude-longitude-countries.csv"):
+    """Read the average latitude and longitude of each country.
+
+    Source: https://github.com/albertyw/avenews/blob/master/old/data/average-latitude-longitude-countries.csv
+    """
     geo = {}
-    fname = "average-latitude-longitude-countries.csv"
     with open(fname) as csv_file:
         csv_reader = csv.reader(csv_file, delimiter=',')
         next(csv_reader, None)  # skip the headers
@@ -316,8 +674,73 @@ def create_stars_map(fcache, html_name='stars_map.html'):
             geo[country] = (float(record[2]), float(record[3]))
     # Add missing record for Ivory Coast
     geo["ivory coast"] = (8, 6)
-    countries_list, record_count, total_matches = cached_query_results_summary(fcache)
+    return geo
+
+
+@METRICS.stage("parse-gazetteer")
+def read_places_coordinates(cities_fname="world-cities_json.json", coordinates_fname=CITY_COORDINATES_FNAME):
+    """Read the latitude and longitude of the cities and sub-countries, keyed by (country, name).
 
+    world-cities_json.json doesn't have the coordinates of the cities, but it has their GeoNames
+    IDs, so we look them up in GeoNames' table of cities.
+    Source: https://download.geonames.org/export/dump/cities15000.zip
+    When several cities of a country have the same name, we choose the most populous one.  A
+    sub-country is placed at the population-weighted center of its cities.
+    """
+    geonames = {}
+    with open(coordinates_fname, encoding='utf-8') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            geonames[int(fields[0])] = (float(fields[4]), float(fields[5]), int(fields[14] or 0))
+    with open(cities_fname) as f:
+        world_cities = json.load(f)
+
+    cities = {}
+    subcountries = {}
+    for city_record in world_cities:
+        try:
+            latitude, longitude, population = geonames[int(city_record['geonameid'])]
+        except (KeyError, TypeError, ValueError):
+            continue
+        country = city_record['country'].lower()
+        if country == "south korea":
+            # See get_countries_metadata
+            country = "korea"
+        city = (country, city_record['name'].lower())
+        if city not in cities or population > cities[city][2]:
+            cities[city] = (latitude, longitude, population)
+        if city_record['subcountry'] is not None:
+            weight = max(population, 1)
+            sums = subcountries.setdefault((country, city_record['subcountry'].lower()), [0.0, 0.0, 0])
+            sums[0] += latitude * weight
+            sums[1] += longitude * weight
+            sums[2] += weight
+    places = {subcountry: (latitude_sum / weight, longitude_sum / weight)
+              for subcountry, (latitude_sum, longitude_sum, weight) in subcountries.items()}
+    # A city that has the name of a sub-country is more likely to be the place that was meant
+    places.update((city, (latitude, longitude)) for city, (latitude, longitude, population) in cities.items())
+    return places
+
+
+def create_stars_map(fcache, html_name='stars_map.html', geo_cache=None, workers=1, map_level="country",
+                     cell_degrees=0.5):
+    geo_index = load_geo_index()
+    if map_level == "city":
+        matcher = ClassificationCache(geo_index['matcher'], geo_cache)
+        countries = CountryAggregator(matcher)
+        for stars in iter_star_batches(fcache):
+            countries.add(stars)
+        matcher.save()
+        draw_cities_map(countries.place_counts, geo_index, html_name, cell_degrees)
+        return
+    countries_list, record_count, total_matches = cached_query_results_summary(fcache, geo_cache, geo_index,
+                                                                               workers)
+    draw_stars_map(countries_list, total_matches, geo_index['country_coordinates'], html_name)
+
+
+@METRICS.stage("render-map")
+def draw_stars_map(countries_list, total_matches, geo, html_name='stars_map.html'):
+    import folium
     # Make an empty map
     m = folium.Map(location=[20, 0], tiles='Cartodb Positron', zoom_start=3)
 
@@ -346,182 +769,765 @@ def create_stars_map(fcache, html_name='stars_map.html'):
     print("Created HTML file {}".format(html_name))
 
 
-def add_star_for_date(record, starring_log):
-    """Add a star to the stars-count of the date of the specified log record.
+def bin_places(place_counts, place_coordinates, country_coordinates, cell_degrees=0.5):
+    """Sum the stars of the places in each cell of a latitude/longitude grid.
 
-    Convert from string, to datetime.datetime to datetime.date.
+    A place is a (country, matched name) pair, where the name is that of a city, a sub-country
+    or the country itself.  Places without coordinates of their own are put at the center of
+    their country.
+    Return:
+        a list of (latitude, longitude, stars) tuples, one for each cell that has stars, which is
+        positioned at the center of the stars in the cell; the number of stars we couldn't place
+    """
+    if not cell_degrees > 0:
+        raise ValueError("The cell size must be positive (got {})".format(cell_degrees))
+    cells = {}
+    unplaced = 0
+    for (country, place), cnt in place_counts.items():
+        coordinates = place_coordinates.get((country, place), country_coordinates.get(country))
+        if coordinates is None:
+            unplaced += cnt
+            continue
+        latitude, longitude = coordinates
+        cell = cells.setdefault((math.floor(latitude / cell_degrees), math.floor(longitude / cell_degrees)),
+                                [0.0, 0.0, 0])
+        cell[0] += latitude * cnt
+        cell[1] += longitude * cnt
+        cell[2] += cnt
+    return [(latitude_sum / cnt, longitude_sum / cnt, cnt) for latitude_sum, longitude_sum, cnt in cells.values()], \
+        unplaced
+
+
+@METRICS.stage("render-map")
+def draw_cities_map(place_counts, geo_index, html_name='stars_map.html', cell_degrees=0.5, max_markers=1000):
+    """Draw a heatmap of the stars, and a layer of circles with the number of stars in each area.
+
+    Drawing a marker for each star-gazer makes the map too large to open, so the stars are
+    summed in the cells of a grid (see bin_places), and only the cells are drawn.  The circles
+    layer is limited to the `max_markers` cells with the most stars.
     """
-    starred_at_str = record[6]
-    starred_at_datetime = datetime.datetime.strptime(starred_at_str, '%Y-%m-%dT%H:%M:%SZ')
-    starred_at_date = datetime.date(starred_at_datetime.year,
-                                    starred_at_datetime.month,
-                                    starred_at_datetime.day)
-    starring_log[starred_at_date] = starring_log.setdefault(starred_at_date, 0) + 1
+    import folium
+    from folium.plugins import HeatMap
+    place_coordinates = geo_index.get('place_coordinates', {})
+    if not place_coordinates:
+        print("The coordinates of the cities ({}) are missing: the stars are drawn at the centers of their "
+              "countries (see download_metadata.sh)".format(CITY_COORDINATES_FNAME))
+    cells, unplaced = bin_places(place_counts, place_coordinates, geo_index['country_coordinates'], cell_degrees)
+    if unplaced:
+        print("{} stars could not be placed on the map".format(unplaced))
+    total_matches = sum(place_counts.values())
+    max_stars = max((cnt for latitude, longitude, cnt in cells), default=1)
 
+    m = folium.Map(location=[20, 0], tiles='Cartodb Positron', zoom_start=3)
+    HeatMap([[round(latitude, 4), round(longitude, 4), cnt / max_stars] for latitude, longitude, cnt in cells],
+            name="Stars heatmap", radius=15, min_opacity=0.3).add_to(m)
+    # A single GeoJSON layer is several times smaller than a folium.CircleMarker per cell
+    largest_cells = sorted(cells, key=lambda cell: cell[2], reverse=True)[:max_markers]
+    features = [{"type": "Feature",
+                 "geometry": {"type": "Point", "coordinates": [round(longitude, 4), round(latitude, 4)]},
+                 "properties": {"stars": "{} ({:.2f}%)".format(cnt, cnt*100/total_matches),
+                                "radius": round(3 + 20 * math.sqrt(cnt / max_stars))}}
+                for latitude, longitude, cnt in largest_cells]
+    folium.GeoJson({"type": "FeatureCollection", "features": features},
+                   name="Stars per area",
+                   show=False,
+                   marker=folium.CircleMarker(color='crimson', weight=1, fill=True, fill_color='crimson'),
+                   style_function=lambda feature: {"radius": feature["properties"]["radius"]},
+                   tooltip=folium.GeoJsonTooltip(fields=["stars"], aliases=["Stars"])).add_to(m)
+    folium.LayerControl().add_to(m)
+    m.save(html_name)
+    print("Created HTML file {}".format(html_name))
 
-def group_by_date_df(fcache, group_type):
-    """Monthly trending stars data"""
-    assert group_type in ["monthly", "daily"]
 
-    starring_log = {}
-    with open(fcache) as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-        for record in csv_reader:
-            add_star_for_date(record, starring_log)
-
-    group = {}
-    for date, cnt in starring_log.items():
-        if group_type == "monthly":
-            key = str(date.month) + "/" + str(date.year)
-        elif group_type == "daily":
-            key = date
-        group[key] = group.setdefault(key, 0) + cnt
-    total = 0
-    if group_type == "monthly":
-        df = pd.DataFrame(columns=['Month', 'New Stars', 'Cumulative Stars'])
-    else:
-        df = pd.DataFrame(columns=['Date', 'New Stars', 'Cumulative Stars'])
-    for month, cnt in group.items():
-        total += cnt
-        df.loc[len(df.index)] = ([month, cnt, total])
-    return df
+@METRICS.stage("load-times")
+def read_starring_times(fcache):
+    """Return the starring times of all of the stars in the cache, as a sorted datetime64 array.
+
+    The times are parsed in bulk (or read as-is from a columnar cache), and sorted, so that any
+    time range can be selected with a binary search.
+    """
+    import pandas as pd
+    columns = load_columnar_cache(fcache)
+    if columns is not None:
+        return np.sort(columns['starred_at'])
+    with open(fcache, "rb") as f:
+        size = f.seek(0, os.SEEK_END)
+        end = complete_rows_size(f)
+        if end < size:
+            # Ignore a partially written last row
+            f.seek(0)
+            fcache = io.BytesIO(f.read(end))
+    try:
+        starred_at = pd.read_csv(fcache, header=None, names=CACHE_COLUMNS, usecols=['starred_at'],
+                                 dtype=str)['starred_at']
+    except pd.errors.EmptyDataError:
+        return np.array([], dtype='datetime64[s]')
+    return np.sort(parse_starred_at(starred_at.tolist()))
+
+
+def time_range_bounds(starring_times, since=None, until=None):
+    """Return the indices of the first and last+1 stars between `since` and `until` (inclusive).
+
+    `since` and `until` are dates (YYYY-MM-DD) or months (YYYY-MM).  `until` includes all of
+    its day or month.
+    """
+    since, until_end = time_range_limits(since, until)
+    start = 0 if since is None else np.searchsorted(starring_times, since, 'left')
+    end = len(starring_times) if until_end is None else np.searchsorted(starring_times, until_end, 'left')
+    return start, max(start, end)
+
+
+def time_range_limits(since=None, until=None):
+    """Return the start of `since` and the end (exclusive) of `until`, as datetime64 values (or None)"""
+    return (None if since is None else np.datetime64(since),
+            None if until is None else np.datetime64(until) + 1)
+
 
+def floor_times(starring_times, granularity):
+    """Round the starring times down to the start of their day, week (Monday) or month"""
+    if granularity == "month":
+        return starring_times.astype('datetime64[M]')
+    days = starring_times.astype('datetime64[D]')
+    if granularity == "week":
+        # The epoch (1970-01-01) was a Thursday
+        return days - (days.astype(np.int64) + 3) % 7
+    return days
 
-def print_history(fcache, group_type):
-    """Monthly trending stars data"""
-    df = group_by_date_df(fcache, group_type)
+
+@METRICS.stage("aggregate")
+def stars_time_series(starring_times, granularity, since=None, until=None):
+    """Count the stars in each day, week, month or day-of-week of a time range.
+
+    Return:
+        period start times (or day-of-week numbers, Monday=0), new stars per period,
+        cumulative stars at the end of each period (including the stars before the range)
+    """
+    assert granularity in ["day", "week", "month", "day-of-week"]
+    start, end = time_range_bounds(starring_times, since, until)
+    selected = starring_times[start:end]
+    if granularity == "day-of-week":
+        days_of_week = (selected.astype('datetime64[D]').astype(np.int64) + 3) % 7
+        counts = np.bincount(days_of_week, minlength=7)
+        return np.arange(7), counts, np.cumsum(counts)
+    # The times are sorted, so the periods come out in chronological order
+    periods, counts = np.unique(floor_times(selected, granularity), return_counts=True)
+    return periods, counts, start + np.cumsum(counts)
+
+
+def group_by_date_df(fcache, group_type, since=None, until=None):
+    """Trending stars data, grouped by month, week, day, or day of the week"""
+    assert group_type in ["monthly", "weekly", "daily", "day-of-week"]
+    granularity = {"monthly": "month", "weekly": "week", "daily": "day", "day-of-week": "day-of-week"}[group_type]
+    periods, counts, cumulative = stars_time_series(read_starring_times(fcache), granularity, since, until)
+    return time_series_df(group_type, periods, counts, cumulative)
+
+
+@METRICS.stage("dataframe")
+def time_series_df(group_type, periods, counts, cumulative):
+    import pandas as pd
+    if group_type == "monthly":
+        labels = [str(month.month) + "/" + str(month.year) for month in periods.astype('datetime64[D]').tolist()]
+        return pd.DataFrame({'Month': labels, 'New Stars': counts, 'Cumulative Stars': cumulative})
+    if group_type == "day-of-week":
+        return pd.DataFrame({'Day': [calendar.day_name[day] for day in periods], 'Stars': counts})
+    column = 'Week' if group_type == "weekly" else 'Date'
+    return pd.DataFrame({column: periods.tolist(), 'New Stars': counts, 'Cumulative Stars': cumulative})
+
+
+def print_history(fcache, group_type, since=None, until=None):
+    """Trending stars data"""
+    from tabulate import tabulate
+    df = group_by_date_df(fcache, group_type, since, until)
     t = tabulate(df, headers='keys', tablefmt='psql', floatfmt=".5f")
     print(t)
 
 
-def plot_history(fcache, group_type):
-    """Monthly trending stars data"""
-    df = group_by_date_df(fcache, group_type)
-    if group_type == "monthly":
-        plt.plot(df['Month'], df['New Stars'], marker='o', markerfacecolor='blue', markersize=8, color='skyblue', linewidth=3)
-    else:
-        plt.plot(df['Date'], df['New Stars'], marker='o', markerfacecolor='blue', markersize=8, color='skyblue',
-                 linewidth=3)
-    #plt.title('New stars activity for ' + start_of_month.strftime("%B/%Y"))
+def plot_history(fcache, group_type, since=None, until=None):
+    """Trending stars data"""
+    import matplotlib.pyplot as plt
+    df = group_by_date_df(fcache, group_type, since, until)
+    plt.plot(df[df.columns[0]], df[df.columns[1]], marker='o', markerfacecolor='blue', markersize=8, color='skyblue',
+             linewidth=3)
     plt.xticks(rotation=90)
     plt.ylabel('Stars');
     plt.show()
 
 
-def daily_history_df(fcache, desired_month, desired_year):
-    """Daily trending stars data"""
-    starring_log = {}
-    with open(fcache) as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-        for record in csv_reader:
-            add_star_for_date(record, starring_log)
-
-    daily = {}
-    total = 0
-    start_of_month = datetime.date(desired_year, desired_month, 1)
-    for date, cnt in starring_log.items():
-        if date < start_of_month:
-            total += cnt
-        if date.month == desired_month:
-            key = str(date.day) + "/" + str(date.month)
-            daily[key] = daily.setdefault(key, 0) + cnt
-
-    df = pd.DataFrame(columns=['Date', 'New Stars', 'Cumulative Stars'])
-    for month, cnt in daily.items():
-        total += cnt
-        df.loc[len(df.index)] = ([month, cnt, total])
-    return df
-
-
-def print_daily_history(fcache, desired_month=9, desired_year=2018):
-    df = daily_history_df(fcache, desired_month, desired_year)
+def daily_history_df(fcache, since=None, until=None):
+    """Daily trending stars data, for a single month by default.
+
+    If no range is given, we show the month of the most recent star.
+    """
+    import pandas as pd
+    starring_times = read_starring_times(fcache)
+    if since is None and until is None and len(starring_times) > 0:
+        since = until = starring_times[-1].astype('datetime64[M]')
+    periods, counts, cumulative = stars_time_series(starring_times, "day", since, until)
+    labels = [str(date.day) + "/" + str(date.month) for date in periods.tolist()]
+    return pd.DataFrame({'Date': labels, 'New Stars': counts, 'Cumulative Stars': cumulative}), since, until
+
+
+def print_daily_history(fcache, since=None, until=None):
+    from tabulate import tabulate
+    df, since, until = daily_history_df(fcache, since, until)
     t = tabulate(df, headers='keys', tablefmt='psql', floatfmt=".5f")
     print(t)
 
 
-def plot_daily_history(fcache, desired_month=6, desired_year=2018):
-    df = daily_history_df(fcache, desired_month, desired_year)
+def plot_daily_history(fcache, since=None, until=None):
+    import matplotlib.pyplot as plt
+    df, since, until = daily_history_df(fcache, since, until)
     plt.plot(df['Date'], df['New Stars'], marker='o', markerfacecolor='blue', markersize=8, color='skyblue', linewidth=3)
-    start_of_month = datetime.date(desired_year, desired_month, 1)
-    plt.title('New stars activity for ' + start_of_month.strftime("%B/%Y"))
+    plt.title('New stars activity for {} - {}'.format(since, until))
     plt.xticks(rotation=90)
     plt.ylabel('Stars');
     plt.show()
 
 
-def add_star_for_day_of_week(record, starring_log):
-    starred_at = record[6]
-    starred = datetime.datetime.strptime(starred_at, '%Y-%m-%dT%H:%M:%SZ')
-    day_of_week = starred.weekday()
-    starring_log[day_of_week] = starring_log.setdefault(day_of_week, 0) + 1
-
-
-# def print_day_of_week_history(fcache):
-#     """Print the number of stars per each day of the week"""
-#     daily_log = {}
-#     day_of_week_log = {}
-#     with open(fcache) as csv_file:
-#         csv_reader = csv.reader(csv_file, delimiter=',')
-#         for record in csv_reader:
-#             add_star_for_day_of_week(record, day_of_week_log)
-#             add_star_for_date(record, daily_log)
-#
-#     # Remove outliers.
-#     # Certain events, like an announcement over social media, can cause a daily peak that is an outlier and
-#     # not indicative of the steady-state star-gazers behavior.  We can remove these events, to get a "cleaner"
-#     # view of the gazers behavior.  You might have to look at the data and experiment.
-#     # In this case, I only remove the highest single-day starring event.
-#     daily_log = sorted(daily_log.items(), key=lambda kv: kv[1], reverse=True)
-#     outlier_date = daily_log[0][0]
-#     outlier_val = daily_log[0][1]
-#     outlier_date = datetime.datetime(outlier_date)
-#     day_of_week_log[outlier_date.weekday()] -= outlier_val
-#     print(day_of_week_log)
+def iter_star_batches(fcache, batch_size=100000):
+    """Read the cache once, and generate batches of its records, as columns.
+
+    Each batch is a dictionary holding the dictionary-encoded location features (see
+    star_cache.convert_cache), and the starring times of the records.
+    """
+    columns = load_columnar_cache(fcache)
+    if columns is not None:
+        feature_values = columns['location_feature_values']
+        feature_codes = columns['location_feature_codes']
+        starred_at = columns['starred_at']
+        for start in range(0, len(feature_codes), batch_size):
+            yield {'location_feature_values': feature_values,
+                   'location_feature_codes': feature_codes[start:start+batch_size],
+                   'starred_at': starred_at[start:start+batch_size]}
+        return
+    with open(fcache) as csv_file:
+        # The cache may be appended to while we read it (e.g. by the crawler, while it is served)
+        csv_reader = csv.reader(complete_lines(csv_file), delimiter=',')
+        while True:
+            records = list(itertools.islice(csv_reader, batch_size))
+            if not records:
+                break
+            feature_codes = {}
+            codes = [feature_codes.setdefault(get_location_feature(record), len(feature_codes)) for record in records]
+            yield {'location_feature_values': list(feature_codes),
+                   'location_feature_codes': np.array(codes, dtype=np.int32),
+                   'starred_at': parse_starred_at([record[6] for record in records])}
+
+
+class CountryAggregator(object):
+    """Count the stars from each country, and from each place (see bin_places) in it"""
+    def __init__(self, matcher):
+        self.matcher = matcher
+        self.counts = {}
+        self.place_counts = {}
+        self.record_count = 0
+
+    def add(self, stars):
+        feature_values = stars['location_feature_values']
+        counts = np.bincount(stars['location_feature_codes'], minlength=len(feature_values))
+        for code in np.flatnonzero(counts):
+            matched_country, matched_str, reason = self.matcher.match(str(feature_values[code]))
+            if matched_country is not None:
+                self.counts[matched_country] = self.counts.get(matched_country, 0) + int(counts[code])
+                place = (matched_country, matched_str)
+                self.place_counts[place] = self.place_counts.get(place, 0) + int(counts[code])
+        self.record_count += len(stars['location_feature_codes'])
+
+    def countries_list(self):
+        """Return the countries in the same format as cached_query_results_summary"""
+        return sorted(((country, {"count": cnt}) for country, cnt in self.counts.items()),
+                      key=lambda kv: kv[1]["count"], reverse=True)
+
+    def df(self):
+        return countries_df(self.countries_list(), self.record_count, sum(self.counts.values()))
+
+
+class TimeAggregator(object):
+    """Count the new stars in each day, week or month of a time range"""
+    def __init__(self, group_type, since=None, until=None):
+        self.group_type = group_type
+        self.granularity = {"monthly": "month", "weekly": "week", "daily": "day"}[group_type]
+        self.since, self.until_end = time_range_limits(since, until)
+        self.counts = {}
+        # The number of stars before the time range, which we need for the cumulative count
+        self.stars_before = 0
+
+    def add(self, stars):
+        starred_at = stars['starred_at']
+        in_range = np.ones(len(starred_at), dtype=bool)
+        if self.since is not None:
+            in_range &= starred_at >= self.since
+            self.stars_before += int(np.count_nonzero(starred_at < self.since))
+        if self.until_end is not None:
+            in_range &= starred_at < self.until_end
+        periods, counts = np.unique(floor_times(starred_at[in_range], self.granularity), return_counts=True)
+        for period, cnt in zip(periods.tolist(), counts.tolist()):
+            self.counts[period] = self.counts.get(period, 0) + cnt
+
+    def df(self):
+        periods = sorted(self.counts)
+        counts = np.array([self.counts[period] for period in periods], dtype=np.int64)
+        periods = np.array(periods, dtype='datetime64[M]' if self.granularity == "month" else 'datetime64[D]')
+        return time_series_df(self.group_type, periods, counts, self.stars_before + np.cumsum(counts))
+
+
+class DayOfWeekAggregator(object):
+    """Count the stars per each day of the week.
+
+    Certain events, like an announcement over social media, can cause a daily peak that is an outlier and
+    not indicative of the steady-state star-gazers behavior.  We can remove these events, to get a "cleaner"
+    view of the gazers behavior.  You might have to look at the data and experiment.
+    By default, we only remove the highest single-day starring event.
+    """
+    def __init__(self, since=None, until=None, outlier_days=1):
+        self.since, self.until_end = time_range_limits(since, until)
+        self.outlier_days = outlier_days
+        self.daily_counts = {}
+
+    def add(self, stars):
+        starred_at = stars['starred_at']
+        in_range = np.ones(len(starred_at), dtype=bool)
+        if self.since is not None:
+            in_range &= starred_at >= self.since
+        if self.until_end is not None:
+            in_range &= starred_at < self.until_end
+        days, counts = np.unique(starred_at[in_range].astype('datetime64[D]'), return_counts=True)
+        for day, cnt in zip(days.tolist(), counts.tolist()):
+            self.daily_counts[day] = self.daily_counts.get(day, 0) + cnt
+
+    def df(self):
+        import pandas as pd
+        stars = np.zeros(7, dtype=np.int64)
+        for day, cnt in self.daily_counts.items():
+            stars[day.weekday()] += cnt
+        without_outliers = stars.copy()
+        outliers = sorted(self.daily_counts.items(), key=lambda kv: kv[1], reverse=True)[:self.outlier_days]
+        for day, cnt in outliers:
+            print("Removing outlier day {} ({} stars)".format(day, cnt))
+            without_outliers[day.weekday()] -= cnt
+        return pd.DataFrame({'Day': list(calendar.day_name),
+                             'Stars': stars,
+                             'Stars (outliers removed)': without_outliers})
+
+
+PLOT_HTML_PAGE = """<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>{title}</title></head>
+<body>
+<h1>{title}</h1>
+{plot}
+{table}
+</body>
+</html>
+"""
+
+
+@METRICS.stage("render-plot")
+def save_plot(df, x, y, title, fname, kind="line", output_format=None):
+    """Draw a plot to a file, without opening a window.
+
+    The format (png, svg or html) is taken from the file name, unless `output_format` is given.
+    An html file holds the plot (as svg) followed by its table.
+    `y` is a column, or a list of columns which are drawn as separate series.
+    """
+    # Use the object-oriented API, which doesn't depend on pyplot's (interactive) backend
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=(20, 10))
+    ax = fig.subplots()
+    if isinstance(y, list):
+        # Several series (e.g. one per repository), side by side
+        positions = np.arange(len(df))
+        for i, column in enumerate(y):
+            if kind == "bar":
+                width = 1 / 1.5 / len(y)
+                ax.bar(positions + (i - (len(y) - 1) / 2) * width, df[column], width=width, label=column)
+            else:
+                ax.plot(positions, df[column], marker='o', markersize=4, linewidth=2, label=column)
+        ax.set_xticks(positions, df[x].astype(str))
+        ax.legend()
+    elif kind == "bar":
+        ax.bar(df[x].astype(str), df[y], width = 1/1.5)
+    else:
+        ax.plot(df[x].astype(str), df[y], marker='o', markerfacecolor='blue', markersize=8, color='skyblue',
+                linewidth=3)
+    ax.set_title(title)
+    ax.set_ylabel('Stars')
+    ax.tick_params(axis='x', labelrotation=90)
+    if output_format is None:
+        output_format = os.path.splitext(fname)[1][1:] or "png"
+    if output_format == "html":
+        svg = io.StringIO()
+        fig.savefig(svg, format="svg", bbox_inches='tight')
+        svg = svg.getvalue()
+        with open(fname, "w") as f:
+            f.write(PLOT_HTML_PAGE.format(title=html.escape(title), plot=svg[svg.index("<svg"):],
+                                          table=df.to_html(index=False)))
+    else:
+        fig.savefig(fname, format=output_format, bbox_inches='tight')
+
+
+def create_report(fcache, report_dir="report", geo_cache=None, since=None, until=None):
+    """Create all of the tables, plots and the map, while reading the cache only once.
+
+    Each batch of records is fed to all of the aggregators, and each aggregator produces a
+    table.  The time range only applies to the stars history tables.
+    """
+    from tabulate import tabulate
+    geo_index = load_geo_index()
+    matcher = ClassificationCache(geo_index['matcher'], geo_cache)
+    countries = CountryAggregator(matcher)
+    aggregators = {"countries": countries,
+                   "monthly": TimeAggregator("monthly", since, until),
+                   "weekly": TimeAggregator("weekly", since, until),
+                   "daily": TimeAggregator("daily", since, until),
+                   "day_of_week": DayOfWeekAggregator(since, until)}
+    with METRICS.stage("aggregate"):
+        for stars in iter_star_batches(fcache):
+            for aggregator in aggregators.values():
+                aggregator.add(stars)
+    matcher.save()
+
+    os.makedirs(report_dir, exist_ok=True)
+    tables = {name: aggregator.df() for name, aggregator in aggregators.items()}
+    for name, df in tables.items():
+        df.to_csv(os.path.join(report_dir, name + ".csv"), index=False)
+    save_plot(tables["countries"], 'Country', '% extrapolated', 'Stars Per Country (%)',
+              os.path.join(report_dir, "countries.png"), kind="bar")
+    for name in ["monthly", "weekly", "daily"]:
+        df = tables[name]
+        save_plot(df, df.columns[0], 'New Stars', 'New stars ({})'.format(name),
+                  os.path.join(report_dir, name + ".png"))
+    save_plot(tables["day_of_week"], 'Day', 'Stars (outliers removed)', 'Stars per day of the week',
+              os.path.join(report_dir, "day_of_week.png"), kind="bar")
+    draw_stars_map(countries.countries_list(), sum(countries.counts.values()),
+                   geo_index['country_coordinates'], os.path.join(report_dir, "stars_map.html"))
+    draw_cities_map(countries.place_counts, geo_index, os.path.join(report_dir, "cities_map.html"))
+    print(tabulate(tables["countries"], headers='keys', tablefmt='psql', floatfmt=".5f"))
+    print("Total: ", countries.record_count)
+    print("Location cache: {} hits, {} misses".format(matcher.hits, matcher.misses))
+    print("Created report in {}".format(report_dir))
+
+
+def velocity_summary(name, starring_times, record_count, located, reference_time):
+    """Summarize how fast a repository gathers stars: overall, and in the last 30 and 90 days.
+
+    The recent windows end at `reference_time` (the newest star of all of the compared
+    repositories), so repositories whose caches were last updated at different times are
+    still compared over the same days.
+    """
+    summary = {'Repository': name, 'Stars': record_count,
+               'Located (%)': 100 * located / record_count if record_count else 0.0}
+    if len(starring_times) == 0:
+        return summary
+    days = max((reference_time - starring_times[0]) / np.timedelta64(1, 'D'), 1)
+    summary.update({'First star': str(starring_times[0].astype('datetime64[D]')),
+                    'Last star': str(starring_times[-1].astype('datetime64[D]')),
+                    'Stars/day': len(starring_times) / days})
+    for window in [30, 90]:
+        recent = len(starring_times) - np.searchsorted(starring_times, reference_time - np.timedelta64(window, 'D'),
+                                                       'right')
+        summary['Stars/day (last {} days)'.format(window)] = recent / window
+    months, counts = np.unique(starring_times.astype('datetime64[M]'), return_counts=True)
+    peak = np.argmax(counts)
+    summary['Peak month'] = str(months[peak])
+    summary['Peak month stars'] = int(counts[peak])
+    return summary
+
+
+def create_comparison(fcaches, report_dir="comparison", geo_cache=None, since=None, until=None, top_countries=15):
+    """Compare the star-gazers of several repositories (one cache file each), side by side.
+
+    Write tables and plots of the share of the stars from each country, of the new stars per
+    month, and a summary of the star velocity of each repository.  The caches share one
+    ClassificationCache, so each unique location is classified once across all of them.
+    The time range only applies to the monthly table.
+    """
+    import pandas as pd
+    from tabulate import tabulate
+    names = [cache_name(fcache) for fcache in fcaches]
+    if len(set(names)) != len(names):
+        raise ValueError("The compared cache files must have different names: {}".format(", ".join(fcaches)))
+    geo_index = load_geo_index()
+    matcher = ClassificationCache(geo_index['matcher'], geo_cache)
+    countries = {}
+    starring_times = {}
+    with METRICS.stage("aggregate"):
+        for name, fcache in zip(names, fcaches):
+            countries[name] = CountryAggregator(matcher)
+            times = []
+            for stars in iter_star_batches(fcache):
+                countries[name].add(stars)
+                times.append(stars['starred_at'])
+            starring_times[name] = np.sort(np.concatenate(times)) if times else np.array([], dtype='datetime64[s]')
+    matcher.save()
+
+    # The share of each country, out of the located stars of each repository
+    shares = {name: {country: 100 * cnt / max(sum(aggregator.counts.values()), 1)
+                     for country, cnt in aggregator.counts.items()}
+              for name, aggregator in countries.items()}
+    top = set()
+    for name in names:
+        top.update(sorted(shares[name], key=shares[name].get, reverse=True)[:top_countries])
+    top = sorted(top, key=lambda country: sum(shares[name].get(country, 0) for name in names), reverse=True)
+    share_table = pd.DataFrame({'Country': top + ['Other']})
+    for name in names:
+        share_table[name] = [shares[name].get(country, 0.0) for country in top] + \
+                            [sum(share for country, share in shares[name].items() if country not in top)]
+
+    non_empty = [times[-1] for times in starring_times.values() if len(times)]
+    reference_time = max(non_empty) if non_empty else None
+    velocity_table = pd.DataFrame([velocity_summary(name, starring_times[name], countries[name].record_count,
+                                                    sum(countries[name].counts.values()), reference_time)
+                                   for name in names])
+
+    monthly = {}
+    for name in names:
+        periods, counts, cumulative = stars_time_series(starring_times[name], "month", since, until)
+        monthly[name] = dict(zip(periods.tolist(), counts.tolist()))
+    months = sorted(set().union(*monthly.values()))
+    if months:
+        months = np.arange(np.datetime64(months[0], 'M'), np.datetime64(months[-1], 'M') + 1)
+    monthly_table = pd.DataFrame({'Month': [str(month.month) + "/" + str(month.year)
+                                            for month in np.asarray(months, dtype='datetime64[D]').tolist()]})
+    for name in names:
+        monthly_table[name] = [monthly[name].get(month, 0) for month in np.asarray(months).tolist()]
+
+    os.makedirs(report_dir, exist_ok=True)
+    for table_name, df in [("country_share", share_table), ("velocity", velocity_table), ("monthly", monthly_table)]:
+        df.to_csv(os.path.join(report_dir, table_name + ".csv"), index=False)
+    save_plot(share_table, 'Country', names, 'Stars Per Country (% of the located stars)',
+              os.path.join(report_dir, "country_share.png"), kind="bar")
+    save_plot(monthly_table, 'Month', names, 'New stars (monthly)', os.path.join(report_dir, "monthly.png"))
+    print(tabulate(share_table, headers='keys', tablefmt='psql', floatfmt=".2f", showindex=False))
+    print(tabulate(velocity_table, headers='keys', tablefmt='psql', floatfmt=".2f", showindex=False))
+    print("Location cache: {} unique locations classified, {} hits".format(matcher.misses, matcher.hits))
+    print("Created comparison in {}".format(report_dir))
+
+
+FILE_FORMATS = ["png", "svg", "html"]
+
+
+def write_plot(args, df, x, y, title, kind="line"):
+    """Write the output of a command to a png, svg or html file (by default, named after the command)"""
+    fname = args.output_fname or "{}.{}".format(args.command, args.output_format)
+    save_plot(df, x, y, title, fname, kind, args.output_format)
+    print("Created {} file {}".format(args.output_format.upper(), fname))
+
+
+def positive_float(value):
+    """An ArgumentParser type for numbers which must be positive (e.g. sizes)"""
+    try:
+        number = float(value)
+    except ValueError:
+        raise ArgumentTypeError("{} is not a number".format(value))
+    if not number > 0:
+        raise ArgumentTypeError("{} is not positive".format(value))
+    return number
+
+
+def parse_repos(repos):
+    """Return the list of repositories given on the command line: a comma-separated list of URLs,
+    or @<file> to read them from a file (one per line; empty lines and #comments are ignored)"""
+    if repos is None:
+        return []
+    if repos.startswith("@"):
+        with open(repos[1:]) as f:
+            repos = [line.split("#", 1)[0].strip() for line in f]
+    else:
+        repos = [repo.strip() for repo in repos.split(",")]
+    # A repository which is listed twice is only crawled once
+    unique_repos = {}
+    for repo in repos:
+        if repo:
+            unique_repos.setdefault(repo_owner_name(repo).lower(), repo)
+    return list(unique_repos.values())
+
+
+def command_cache_files(args):
+    """Return the cache files of a command: one per repository when several repositories (or a
+    --cache-dir) are given, and otherwise the comma-separated list of --cache-file"""
+    repos = parse_repos(args.git_repo)
+    if args.cache_dir or len(repos) > 1:
+        return [repo_cache_fname(repo, args.cache_dir or ".") for repo in repos]
+    return args.cache_file.split(",")
+
+
+def run_command(args):
+    if args.command in ["query-github", "update"]:
+        from github_crawler import query_github, query_github_graphql, update_github, query_github_batch, UserCache
+        user_cache = UserCache(args.user_cache, args.user_cache_ttl) if args.user_cache else None
+        repos = parse_repos(args.git_repo)
+        if not repos:
+            raise ValueError("{} needs a repository: use --repo".format(args.command))
+        fcaches = command_cache_files(args)
+        errors = {}
+        if len(repos) > 1 or args.cache_dir:
+            totals, errors = query_github_batch(args.git_user, args.git_pw, repos, fcaches, args.proxy,
+                                                workers=args.workers, api=args.api,
+                                                update=args.command == "update", resume=not args.restart,
+                                                user_cache=user_cache, sync_rows=args.sync_rows,
+                                                sync_seconds=args.sync_seconds, adopt=args.adopt)
+        elif args.command == "query-github" and args.api == "graphql":
+            query_github_graphql(args.git_user, args.git_pw, repos[0], args.proxy, fname=args.cache_file,
+                                 resume=not args.restart, user_cache=user_cache,
+                                 sync_rows=args.sync_rows, sync_seconds=args.sync_seconds)
+        elif args.command == "query-github":
+            query_github(args.git_user, args.git_pw, repos[0], args.proxy, fname=args.cache_file,
+                         workers=args.workers, resume=not args.restart, user_cache=user_cache,
+                         sync_rows=args.sync_rows, sync_seconds=args.sync_seconds)
+        else:
+            update_github(args.git_user, args.git_pw, repos[0], args.proxy, fname=args.cache_file,
+                          workers=args.workers, user_cache=user_cache,
+                          sync_rows=args.sync_rows, sync_seconds=args.sync_seconds, restart=args.restart,
+                          adopt=args.adopt)
+        if user_cache is not None:
+            user_cache.close()
+        for fcache in fcaches:
+            if os.path.exists(columnar_cache_fname(fcache)):
+                # Keep the columnar cache in sync with the CSV file
+                convert_cache(fcache)
+        if errors:
+            raise ValueError("Failed to query {} of the {} repositories: {}".format(
+                len(errors), len(repos), ", ".join(errors)))
+    if args.command == "convert":
+        convert_cache(args.cache_file)
+    if args.command == "build-index":
+        build_geo_index()
+    if args.command == "stars-geo-tbl":
+        if args.output_format == "plot":
+            plot_stars_per_country(args.cache_file, args.geo_cache, args.workers)
+        elif args.output_format in FILE_FORMATS:
+            df = cached_query_results_df(args.cache_file, args.geo_cache, args.workers)
+            write_plot(args, df, 'Country', '% extrapolated', 'Stars Per Country (%)', kind="bar")
+        else:
+            print_stars_per_country(args.cache_file, args.geo_cache, args.workers)
+    if args.command == "stars-geo-map":
+        create_stars_map(args.cache_file, args.output_fname or 'stars_map.html', args.geo_cache, args.workers,
+                         args.map_level, args.cell_degrees)
+    if args.command in ["monthly", "weekly", "daily", "day-of-week"]:
+        if args.output_format == "plot":
+            plot_history(args.cache_file, args.command, args.since, args.until)
+        elif args.output_format in FILE_FORMATS:
+            df = group_by_date_df(args.cache_file, args.command, args.since, args.until)
+            write_plot(args, df, df.columns[0], df.columns[1], 'Stars ({})'.format(args.command),
+                       kind="bar" if args.command == "day-of-week" else "line")
+        else:
+            print_history(args.cache_file, args.command, args.since, args.until)
+    if args.command == "detailed-month":
+        if args.output_format == "plot":
+            plot_daily_history(args.cache_file, args.since, args.until)
+        elif args.output_format in FILE_FORMATS:
+            df, since, until = daily_history_df(args.cache_file, args.since, args.until)
+            write_plot(args, df, 'Date', 'New Stars', 'New stars activity for {} - {}'.format(since, until))
+        else:
+            print_daily_history(args.cache_file, args.since, args.until)
+    if args.command == "report":
+        create_report(args.cache_file, args.report_dir or "report", args.geo_cache, args.since, args.until)
+    if args.command == "compare":
+        create_comparison(command_cache_files(args), args.report_dir or "comparison", args.geo_cache,
+                          args.since, args.until)
+    if args.command == "serve":
+        from stars_server import serve
+        serve(command_cache_files(args), args.host, args.port, args.geo_cache)
 
 
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument('command',
                         choices=["query-github",
+                                 "update",
+                                 "build-index",
+                                 "convert",
                                  "stars-geo-map",
                                  "stars-geo-tbl",
                                  "monthly",
+                                 "weekly",
                                  "daily",
-                                 #"day-of-week",
-                                 "detailed-month"],
+                                 "day-of-week",
+                                 "detailed-month",
+                                 "report",
+                                 "compare",
+                                 "serve"],
                         help='path to dataset')
     parser.add_argument("-u", "--user", dest="git_user", help="git user name")
     parser.add_argument("-p", "--password", dest="git_pw", help="git user password")
     parser.add_argument("-x", "--proxy", dest="proxy", help="HTTPS proxy", default=None)
     parser.add_argument("-r", "--repo",
                         dest="git_repo",
-                        help="git repo URL (e.g. https://github.com/NervanaSystems/distiller)")
+                        help="git repo URL (e.g. https://github.com/NervanaSystems/distiller), or a comma-separated "
+                             "list of URLs, or @<file> listing a URL per line.  query-github and update crawl "
+                             "several repositories under one rate-limit budget, into a cache file per repository "
+                             "(see --cache-dir), and compare compares them")
+    parser.add_argument("-w", "--workers", dest="workers", type=int, default=1,
+                        help="number of concurrent workers used when querying github, "
+                             "or number of processes used to classify the star-gazers' locations")
+    parser.add_argument("--api", choices=["rest", "graphql"], default="rest", dest="api",
+                        help="github API used by query-github: rest|graphql (graphql needs a token as the password)")
+    parser.add_argument("--restart", dest="restart", action="store_true", default=False,
+                        help="ignore an existing cache file and its checkpoint, and query github from the first page "
+                             "(also with update)")
+    parser.add_argument("--adopt", dest="adopt", action="store_true", default=False,
+                        help="let update claim a cache file which doesn't record its repository (e.g. one "
+                             "queried by an older version) for --repo, instead of refusing it")
+    parser.add_argument("--sync-rows", dest="sync_rows", type=int, default=None,
+                        help="sync the cache file to disk every this many star-gazers (1 to sync each of them); "
+                             "by default it is synced once per page")
+    parser.add_argument("--sync-seconds", dest="sync_seconds", type=float, default=None,
+                        help="sync the cache file to disk at least every this many seconds")
+    parser.add_argument("--user-cache", dest="user_cache", default="github_users.db",
+                        help="path to the database caching github user profiles across queries (empty to disable)")
+    parser.add_argument("--user-cache-ttl", dest="user_cache_ttl", type=float, default=30,
+                        help="number of days before a cached user profile is revalidated with github")
     parser.add_argument("-c", "--cache-file", dest="cache_file", default="star_gazers.csv",
-                        help="path to the file caching the results of querying github")
+                        help="path to the file caching the results of querying github "
+                             "(compare and serve accept a comma-separated list of files)")
+    parser.add_argument("--cache-dir", dest="cache_dir", default=None,
+                        help="directory of the cache files of the repositories given with --repo, which are named "
+                             "<owner>_<name>.csv (default: the current directory, when several repositories are given)")
+    parser.add_argument("--geo-cache", dest="geo_cache", default=None,
+                        help="path to a file caching the country classification of locations across runs")
+    parser.add_argument("--map-level", choices=["country", "city"], default="country", dest="map_level",
+                        help="stars-geo-map draws a circle per country, or a heatmap of the cities: country|city")
+    parser.add_argument("--cell-size", dest="cell_degrees", type=positive_float, default=0.5,
+                        help="size (in degrees of latitude and longitude) of the areas in which the city-level map "
+                             "sums the stars")
+    parser.add_argument("--since", dest="since", default=None,
+                        help="first date (YYYY-MM-DD or YYYY-MM) of the stars history commands")
+    parser.add_argument("--until", dest="until", default=None,
+                        help="last date (YYYY-MM-DD or YYYY-MM, inclusive) of the stars history commands")
+    parser.add_argument("--report-dir", dest="report_dir", default=None,
+                        help="directory in which the report (default: report) and compare (default: comparison) "
+                             "commands write their tables, plots and maps")
     parser.add_argument("-f", "--format",
-                        choices=["plot","console"],
+                        choices=["plot", "console"] + FILE_FORMATS,
                         default="console",
                         dest="output_format",
-                        help="output format: plot|console")
+                        help="output format: plot (in a window)|console|png|svg|html (to a file, without a display)")
+    parser.add_argument("-o", "--output", dest="output_fname", default=None,
+                        help="file written by the png, svg and html formats (default: <command>.<format>), "
+                             "or by stars-geo-map (default: stars_map.html)")
+    parser.add_argument("--host", dest="host", default="127.0.0.1", help="address on which serve listens")
+    parser.add_argument("--port", dest="port", type=int, default=8000, help="port on which serve listens")
+    parser.add_argument("--metrics-out", dest="metrics_out", default=None,
+                        help="save the wall time, call count and peak memory of each stage, and the statistics "
+                             "of the github requests, to this JSON file")
+    parser.add_argument("--profile", dest="profile", default=None,
+                        help="save a cProfile dump of the command to this file (view it with python -m pstats)")
     args = parser.parse_args()
-    if args.command == "query-github":
-        query_github(args.git_user, args.git_pw, args.git_repo, args.proxy)
-    if args.command == "stars-geo-tbl":
-        if args.output_format == "plot":
-            plot_stars_per_country(args.cache_file)
-        else:
-            print_stars_per_country(args.cache_file)
-    if args.command == "stars-geo-map":
-        create_stars_map(args.cache_file)
-    if args.command == "monthly" or args.command == "daily":
-        if args.output_format == "plot":
-            plot_history(args.cache_file, group_type=args.command)
-        else:
-            print_history(args.cache_file, group_type=args.command)
-    if args.command == "detailed-month":
-        if args.output_format == "plot":
-            plot_daily_history(args.cache_file)
-        else:
-            print_daily_history(args.cache_file)
-    # if args.command == "day-of-week":
-    #     print_day_of_week_history(args.cache_file)
+    if args.metrics_out:
+        METRICS.enable()
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        with METRICS.stage(args.command):
+            run_command(args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            print("Saved the profile to {}".format(args.profile))
+        if args.metrics_out:
+            METRICS.save(args.metrics_out, args.command)
@@ -0,0 +1,239 @@
+import json
+import os
+import threading
+import time
+import traceback
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+from star_cache import columnar_cache_fname, cache_name
+from stars_analytics import load_geo_index, ClassificationCache, CountryAggregator, iter_star_batches, \
+    stars_time_series, time_series_df, bin_places
+
+
+class StarsData(object):
+    """The classified stars of a cache file, which the server keeps in memory.
+
+    The cache is read once, in batches, to count the stars of each country and place, and to
+    collect the (sorted) starring times.  Queries are then answered from these in-memory
+    summaries, and their answers are memoized, since dashboards ask the same queries over and over.
+    A StarsData is never modified after it is loaded, so any number of threads can query it.
+    """
+    MAX_MEMOIZED = 256
+
+    def __init__(self, fcache, matcher):
+        self.fcache = fcache
+        self.version = cache_version(fcache)
+        self.loaded_at = time.time()
+        countries = CountryAggregator(matcher)
+        starring_times = []
+        for stars in iter_star_batches(fcache):
+            countries.add(stars)
+            starring_times.append(stars['starred_at'])
+        self.countries = countries
+        self.starring_times = np.sort(np.concatenate(starring_times)) if starring_times else \
+            np.array([], dtype='datetime64[s]')
+        self.memo = {}
+        self.memo_lock = threading.Lock()
+
+    def memoized(self, key, fn):
+        with self.memo_lock:
+            if key in self.memo:
+                return self.memo[key]
+        result = fn()
+        with self.memo_lock:
+            if len(self.memo) >= self.MAX_MEMOIZED:
+                self.memo.clear()
+            self.memo[key] = result
+        return result
+
+
+def cache_version(fcache):
+    """Return the modification times and sizes of a cache file, and of the columnar file next to it"""
+    fnames = [fcache] if fcache.endswith(".npz") else [fcache, columnar_cache_fname(fcache)]
+    version = []
+    for fname in fnames:
+        try:
+            st = os.stat(fname)
+            version.append((st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            version.append(None)
+    return tuple(version)
+
+
+class StarsService(object):
+    """Answer geo-table, time-series and map queries about several cache files.
+
+    The geographical index and the classification of the locations are shared by all of the
+    caches.  Before answering a query about a cache, we check whether its file changed on disk,
+    and if so we load it again.  Queries about a cache which is being reloaded wait for it,
+    while queries about other caches are answered meanwhile.
+    """
+    def __init__(self, fcaches, geo_cache=None):
+        self.geo_index = load_geo_index()
+        self.matcher = ClassificationCache(self.geo_index['matcher'], geo_cache)
+        self.fcaches = {}
+        for fcache in fcaches:
+            name = cache_name(fcache)
+            if name in self.fcaches:
+                raise ValueError("Two cache files are named {}: {} and {}".format(name, self.fcaches[name], fcache))
+            self.fcaches[name] = fcache
+        self.data = {}
+        # The versions (see cache_version) of the cache files which failed to load
+        self.failed_versions = {}
+        self.locks = {name: threading.Lock() for name in self.fcaches}
+        self.matcher_lock = threading.Lock()
+        for name in self.fcaches:
+            self.stars(name)
+
+    def stars(self, name):
+        """Return the StarsData of a cache, after loading it again if its file changed.
+
+        If the changed file can't be loaded, we keep serving the previous version of the cache,
+        and only try again after the file changes again.
+        """
+        if name is None and len(self.fcaches) == 1:
+            name = next(iter(self.fcaches))
+        if name not in self.fcaches:
+            raise ValueError("Unknown cache {} (choose from {})".format(name, ", ".join(self.fcaches)))
+        data = self.data.get(name)
+        if data is not None and cache_version(data.fcache) in (data.version, self.failed_versions.get(name)):
+            return data
+        with self.locks[name]:
+            data = self.data.get(name)
+            version = cache_version(self.fcaches[name])
+            if data is None or version not in (data.version, self.failed_versions.get(name)):
+                start = time.time()
+                try:
+                    # The classification cache is shared by the caches, so only one of them is classified at a time
+                    with self.matcher_lock:
+                        new_data = StarsData(self.fcaches[name], self.matcher)
+                        self.matcher.save()
+                except Exception as e:
+                    if data is None:
+                        raise
+                    self.failed_versions[name] = version
+                    print("Failed to reload {} ({!r}): serving the version loaded at {}".format(
+                        data.fcache, e, time.ctime(data.loaded_at)))
+                    return data
+                data = self.data[name] = new_data
+                print("Loaded {} ({} stars) in {:.2f} seconds".format(data.fcache, data.countries.record_count,
+                                                                      time.time() - start))
+        return data
+
+    def caches(self):
+        return [{"cache": name,
+                 "file": data.fcache,
+                 "stars": data.countries.record_count,
+                 "loaded_at": data.loaded_at}
+                for name, data in sorted(self.data.items())]
+
+    def geo_table(self, name=None):
+        data = self.stars(name)
+        return data.memoized(("geo-table",), lambda: df_records(data.countries.df()))
+
+    def time_series(self, name=None, group="monthly", since=None, until=None):
+        if group not in ["monthly", "weekly", "daily", "day-of-week"]:
+            raise ValueError("Unknown group {} (choose from monthly, weekly, daily, day-of-week)".format(group))
+        data = self.stars(name)
+        granularity = {"monthly": "month", "weekly": "week", "daily": "day", "day-of-week": "day-of-week"}[group]
+
+        def query():
+            periods, counts, cumulative = stars_time_series(data.starring_times, granularity, since, until)
+            return df_records(time_series_df(group, periods, counts, cumulative))
+        return data.memoized(("time-series", group, since, until), query)
+
+    def stars_map(self, name=None, level="country", cell_degrees=0.5):
+        if not cell_degrees > 0:
+            raise ValueError("cell-size must be positive (got {})".format(cell_degrees))
+        data = self.stars(name)
+        countries = data.countries
+        total_matches = sum(countries.counts.values())
+        if level == "country":
+            geo = self.geo_index['country_coordinates']
+            return data.memoized(("map", level), lambda: [
+                {"country": country, "stars": country_stats["count"],
+                 "%": country_stats["count"] * 100 / total_matches,
+                 "latitude": geo[country][0], "longitude": geo[country][1]}
+                for country, country_stats in countries.countries_list() if country in geo])
+        if level == "city":
+            def query():
+                cells, unplaced = bin_places(countries.place_counts, self.geo_index.get('place_coordinates', {}),
+                                             self.geo_index['country_coordinates'], cell_degrees)
+                return {"cells": [{"latitude": latitude, "longitude": longitude, "stars": cnt}
+                                  for latitude, longitude, cnt in sorted(cells, key=lambda cell: cell[2],
+                                                                         reverse=True)],
+                        "unplaced": unplaced}
+            return data.memoized(("map", level, cell_degrees), query)
+        raise ValueError("Unknown map level {} (choose from country, city)".format(level))
+
+
+def df_records(df):
+    """Convert a table to a list of JSON-able rows"""
+    return json.loads(df.to_json(orient="records", date_format="iso"))
+
+
+class StarsRequestHandler(BaseHTTPRequestHandler):
+    """Route the GET requests to the service:
+
+    /caches
+    /geo-table?cache=<name>
+    /time-series?cache=<name>&group=monthly|weekly|daily|day-of-week&since=<date>&until=<date>
+    /map?cache=<name>&level=country|city&cell-size=<degrees>
+
+    The cache can be omitted when the server has a single cache.
+    """
+    protocol_version = "HTTP/1.1"
+    service = None
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = {key: values[-1] for key, values in urllib.parse.parse_qs(url.query).items()}
+        try:
+            if url.path == "/caches":
+                result = self.service.caches()
+            elif url.path == "/geo-table":
+                result = self.service.geo_table(query.get("cache"))
+            elif url.path == "/time-series":
+                result = self.service.time_series(query.get("cache"), query.get("group", "monthly"),
+                                                  query.get("since"), query.get("until"))
+            elif url.path == "/map":
+                result = self.service.stars_map(query.get("cache"), query.get("level", "country"),
+                                                float(query.get("cell-size", 0.5)))
+            else:
+                self.send_json({"error": "Unknown path {}".format(url.path)}, status=404)
+                return
+        except ValueError as e:
+            self.send_json({"error": str(e)}, status=400)
+            return
+        except Exception as e:
+            traceback.print_exc()
+            self.send_json({"error": "{}: {}".format(type(e).__name__, e)}, status=500)
+            return
+        self.send_json(result)
+
+    def send_json(self, body, status=200):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve(fcaches, host="127.0.0.1", port=8000, geo_cache=None):
+    """Load the caches, and answer queries about them over HTTP until interrupted"""
+    service = StarsService(fcaches, geo_cache)
+
+    class Handler(StarsRequestHandler):
+        pass
+    Handler.service = service
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    print("Serving {} on http://{}:{}".format(", ".join(service.fcaches), host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,54 @@
+"""CountryMatcher must classify every location exactly as the reference linear scan (match_country) does."""
+import random
+import pytest
+import synthetic
+from star_cache import normalize_location
+from stars_analytics import CountryMatcher, match_country, get_countries_metadata, read_cities_db
+
+
+@pytest.fixture(scope="module")
+def gazetteer(tmp_path_factory):
+    dirname = str(tmp_path_factory.mktemp("gazetteer"))
+    cities = synthetic.generate_gazetteer(dirname, cities_per_country=30)
+    countries_fname, cities_fname = synthetic.gazetteer_fnames(dirname)[:2]
+    return cities, read_cities_db(cities_fname), get_countries_metadata(countries_fname)
+
+
+def assert_same_matches(locations, pairs, details):
+    matcher = CountryMatcher(pairs, details)
+    mismatches = [(location, matcher.match(location), match_country(location, pairs, details))
+                  for location in locations
+                  if matcher.match(location) != match_country(location, pairs, details)]
+    assert mismatches == []
+
+
+def test_synthetic_locations(gazetteer):
+    cities, pairs, details = gazetteer
+    locations = {normalize_location(profile['location'])
+                 for starred_at, profile in synthetic.generate_profiles(3000, cities, seed=4) if profile['location']}
+    # Locations naming several places, which need disambiguation
+    rng = random.Random(5)
+    names = [city for country, city in pairs] + list(details)
+    locations.update(" ".join(rng.sample(names, rng.randint(2, 3))) for _ in range(1000))
+    assert len(locations) > 1000
+    assert_same_matches(sorted(locations), pairs, details)
+
+
+def test_ties():
+    details = {"alpha": ("alphaville", 1000), "beta": ("betatown", 5000), "gamma": ("gammacity", 5000),
+               "delta": ("", 10)}
+    pairs = [("alpha", "alphaville"), ("beta", "betatown"), ("gamma", "gammacity"),
+             # The same city name in two countries
+             ("alpha", "springfield"), ("beta", "springfield"),
+             # Different cities with names of the same length
+             ("alpha", "paris"), ("beta", "perth"), ("gamma", "porto"),
+             # A city whose name is part of another one's
+             ("gamma", "york"), ("beta", "new york"),
+             # An empty name, which is contained in every location
+             ("delta", "")]
+    pairs = sorted(pairs, key=lambda pair: (-len(pair[1]), pair))
+    locations = ["", "springfield", "paris perth", "perth paris", "paris perth porto", "porto perth",
+                 "alphaville beta", "alpha beta", "beta gamma", "gamma beta", "betatown gammacity",
+                 "springfield alphaville", "new york", "york", "new york gamma", "delta", "nowhere",
+                 "alpha beta gamma delta", "gammacity alpha springfield"]
+    assert_same_matches(locations, pairs, details)
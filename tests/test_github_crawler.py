@@ -0,0 +1,191 @@
+"""Crawl a local fake github server (benchmarks/fake_github.py), so the tests run offline."""
+import pytest
+import github_crawler
+import synthetic
+from fake_github import FakeGithub
+
+
+REPO = "https://github.com/bench/repo"
+OTHER_REPO = "https://github.com/bench/other"
+N_STARS = 230
+
+
+@pytest.fixture(scope="module")
+def cities(tmp_path_factory):
+    return synthetic.generate_gazetteer(str(tmp_path_factory.mktemp("gazetteer")), cities_per_country=5)
+
+
+@pytest.fixture
+def github(cities):
+    stars = list(synthetic.generate_profiles(N_STARS, cities, seed=1))
+    other = [(starred_at, dict(profile, login="other-" + profile['login']))
+             for starred_at, profile in synthetic.generate_profiles(120, cities, seed=2)]
+    with FakeGithub(stars, repos={"bench/other": other}) as fake:
+        yield fake
+
+
+def query_rest(github, fname, repo=REPO, workers=4, resume=True):
+    github_crawler.query_github("user", "token", repo, fname=str(fname), workers=workers,
+                                api_url_base=github.api_url, resume=resume)
+
+
+def crawl_graphql(github, fname, repo=REPO, resume=True):
+    session = github_crawler.create_session("user", "token")
+    return list(github_crawler.crawl_stargazers_graphql(session, repo, str(fname), github.api_url, resume))
+
+
+def test_graphql_matches_rest(github, tmp_path):
+    query_rest(github, tmp_path / "rest.csv")
+    pages = crawl_graphql(github, tmp_path / "graphql.csv")
+    # 100 stars per page
+    assert pages == [100, 100, 30]
+    assert (tmp_path / "graphql.csv").read_bytes() == (tmp_path / "rest.csv").read_bytes()
+
+
+def test_graphql_refuses_other_repository(github, tmp_path):
+    fname = tmp_path / "stars.csv"
+    crawl_graphql(github, fname)
+    before = fname.read_bytes()
+    with pytest.raises(ValueError, match="bench/repo"):
+        crawl_graphql(github, fname, repo=OTHER_REPO)
+    assert fname.read_bytes() == before
+    crawl_graphql(github, fname, repo=OTHER_REPO, resume=False)
+    assert len(fname.read_text().splitlines()) == 120
+
+
+def test_switch_api_while_resuming(github, tmp_path):
+    rest_fname = tmp_path / "rest.csv"
+    query_rest(github, rest_fname)
+    complete = rest_fname.read_bytes()
+    # A REST crawl which stopped after page 2 is resumed with GraphQL, which drops its checkpoint
+    fname = tmp_path / "stars.csv"
+    cut = complete.index(b"\n", len(complete) // 2) + 1
+    fname.write_bytes(complete[:cut])
+    github_crawler.save_checkpoint(str(fname), github_crawler.repo_api_url(REPO, github.api_url), 50, 2)
+    github_crawler.save_repo_info(str(fname), REPO, "rest")
+    crawl_graphql(github, fname)
+    assert fname.read_bytes() == complete
+    assert not (tmp_path / "stars.csv.checkpoint").exists()
+    # And a partial GraphQL crawl is resumed with REST
+    fname.write_bytes(complete[:cut])
+    query_rest(github, fname)
+    assert fname.read_bytes() == complete
+
+
+def test_concurrent_crawl_matches_serial(github, tmp_path):
+    query_rest(github, tmp_path / "serial.csv", workers=1)
+    query_rest(github, tmp_path / "concurrent.csv", workers=8)
+    serial = (tmp_path / "serial.csv").read_bytes()
+    assert len(serial.splitlines()) == N_STARS
+    assert (tmp_path / "concurrent.csv").read_bytes() == serial
+
+
+def test_resume_after_truncation(github, tmp_path):
+    fname = tmp_path / "stars.csv"
+    query_rest(github, fname)
+    complete = fname.read_bytes()
+    # A crash in the middle of a row, after the checkpoint of page 2 was saved
+    cut = complete.index(b"\n", len(complete) // 2) + 20
+    fname.write_bytes(complete[:cut])
+    github_crawler.save_checkpoint(str(fname), github_crawler.repo_api_url(REPO, github.api_url), 50, 2)
+    query_rest(github, fname, workers=8)
+    assert fname.read_bytes() == complete
+
+
+def test_restart_after_deleting_cache(github, tmp_path):
+    fname = tmp_path / "stars.csv"
+    query_rest(github, fname)
+    complete = fname.read_bytes()
+    # Deleting the cache file (but not its checkpoint) starts the crawl over, from the first page
+    fname.unlink()
+    query_rest(github, fname)
+    assert fname.read_bytes() == complete
+    fname.write_bytes(b"")
+    query_rest(github, fname, workers=8)
+    assert fname.read_bytes() == complete
+
+
+def test_rest_refuses_other_repository(github, tmp_path):
+    fname = tmp_path / "stars.csv"
+    query_rest(github, fname)
+    before = fname.read_bytes()
+    with pytest.raises(ValueError, match="bench/repo"):
+        query_rest(github, fname, repo=OTHER_REPO)
+    assert fname.read_bytes() == before
+    # Neither can a cache file which doesn't record its repository be appended to
+    (tmp_path / "stars.csv.repo").unlink()
+    (tmp_path / "stars.csv.checkpoint").unlink()
+    with pytest.raises(ValueError, match="--restart"):
+        query_rest(github, fname, repo=OTHER_REPO)
+    query_rest(github, fname, repo=OTHER_REPO, resume=False)
+    assert len(fname.read_text().splitlines()) == 120
+
+
+def test_update_appends_new_stars(github, cities, tmp_path):
+    fname = tmp_path / "stars.csv"
+    query_rest(github, fname)
+    with pytest.raises(ValueError, match="bench/repo"):
+        github_crawler.update_github("user", "token", OTHER_REPO, fname=str(fname), api_url_base=github.api_url)
+    new_stars = [("2030" + starred_at[4:], dict(profile, login="new-" + profile['login']))
+                 for starred_at, profile in synthetic.generate_profiles(20, cities, seed=3)]
+    github.add_stars(new_stars)
+    github_crawler.update_github("user", "token", REPO, fname=str(fname), workers=4, api_url_base=github.api_url)
+    assert len(fname.read_text().splitlines()) == N_STARS + 20
+
+
+def test_update_adopts_unrecorded_cache(github, cities, tmp_path):
+    fname = tmp_path / "stars.csv"
+    query_rest(github, fname)
+    # A cache file queried before the repository was recorded
+    (tmp_path / "stars.csv.repo").unlink()
+    (tmp_path / "stars.csv.checkpoint").unlink()
+    with pytest.raises(ValueError, match="--adopt"):
+        github_crawler.update_github("user", "token", REPO, fname=str(fname), api_url_base=github.api_url)
+    new_stars = [("2030" + starred_at[4:], dict(profile, login="new-" + profile['login']))
+                 for starred_at, profile in synthetic.generate_profiles(20, cities, seed=3)]
+    github.add_stars(new_stars)
+    requests_before = github.stats["requests"]
+    github_crawler.update_github("user", "token", REPO, fname=str(fname), api_url_base=github.api_url, adopt=True)
+    assert len(fname.read_text().splitlines()) == N_STARS + 20
+    # Only the last pages and the new star-gazers' profiles were requested
+    assert github.stats["requests"] - requests_before < 30
+    assert github_crawler.load_repo_info(str(fname))['repo'] == "bench/repo"
+
+
+def test_batch_continues_after_failure(github, tmp_path):
+    fnames = [str(tmp_path / "repo.csv"), str(tmp_path / "other.csv")]
+    # The cache file of the second repository holds the star-gazers of the first one
+    query_rest(github, fnames[1])
+    totals, errors = github_crawler.query_github_batch("user", "token", [REPO, OTHER_REPO], fnames, workers=4,
+                                                       api_url_base=github.api_url)
+    assert totals[REPO] == N_STARS
+    assert list(errors) == [OTHER_REPO] and isinstance(errors[OTHER_REPO], ValueError)
+    assert len((tmp_path / "repo.csv").read_text().splitlines()) == N_STARS
+    assert len((tmp_path / "other.csv").read_text().splitlines()) == N_STARS
+    with pytest.raises(ValueError, match="same cache file"):
+        github_crawler.query_github_batch("user", "token", [REPO, REPO], [fnames[0]] * 2,
+                                          api_url_base=github.api_url)
+
+
+def test_command_line_repositories(tmp_path, monkeypatch):
+    import argparse
+    import stars_analytics
+    monkeypatch.chdir(tmp_path)
+    queried = []
+    monkeypatch.setattr(github_crawler, "query_github", lambda user, pw, repo, *args, **kwargs: queried.append(repo))
+    monkeypatch.setattr(github_crawler, "query_github_batch",
+                        lambda user, pw, repos, *args, **kwargs: queried.append(repos))
+    repos_fname = tmp_path / "repos.txt"
+    repos_fname.write_text("{}  # the only one\n\n".format(REPO))
+
+    def run(repos):
+        stars_analytics.run_command(argparse.Namespace(
+            command="query-github", git_user="user", git_pw="token", proxy=None, git_repo=repos, workers=1,
+            api="rest", restart=False, adopt=False, sync_rows=None, sync_seconds=None, user_cache="", user_cache_ttl=30,
+            cache_file=str(tmp_path / "stars.csv"), cache_dir=None))
+    run("@{}".format(repos_fname))
+    run(REPO + ",")
+    run("{}, {}/".format(REPO, REPO.replace("bench/repo", "Bench/Repo")))
+    assert queried == [REPO] * 3
+    with pytest.raises(ValueError, match="--repo"):
+        run(",")
@@ -0,0 +1,18 @@
+"""Convert synthetic cache files to the columnar format."""
+import star_cache
+import synthetic
+
+
+def test_convert_ignores_partial_row(tmp_path):
+    cities = synthetic.generate_gazetteer(str(tmp_path), cities_per_country=5)
+    fname = tmp_path / "stars.csv"
+    synthetic.generate_cache(str(fname), 50, cities)
+    complete = fname.read_bytes()
+    # A crawl is appending to the cache file: the last row is cut off in the middle of an escape
+    escape = complete.index(b"\\")
+    fname.write_bytes(complete + complete[complete.rfind(b"\n", 0, escape) + 1:escape + 2])
+    star_cache.convert_cache(str(fname))
+    columns = star_cache.load_columnar_cache(str(fname))
+    assert len(columns['id']) == 50
+    assert len(columns['starred_at']) == 50
+    assert len(columns['location_feature_codes']) == 50
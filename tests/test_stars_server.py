@@ -0,0 +1,90 @@
+"""Query a stars server which runs in a background thread, on synthetic caches."""
+import json
+import os
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+import pytest
+import synthetic
+from stars_server import StarsService, StarsRequestHandler
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    # The geographical index is built in the current directory
+    monkeypatch.chdir(tmp_path)
+    cities = synthetic.generate_gazetteer(".", cities_per_country=5)
+    synthetic.generate_cache("stars.csv", 300, cities)
+    service = StarsService(["stars.csv"])
+
+    class Handler(StarsRequestHandler):
+        def log_message(self, format, *args):
+            pass
+    Handler.service = service
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield service, "http://127.0.0.1:{}".format(httpd.server_address[1])
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def get(url):
+    """Return the status and JSON body of a GET request"""
+    try:
+        with urllib.request.urlopen(url) as r:
+            return r.status, json.loads(r.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def total_stars(base_url):
+    # Only the queries about a cache load it again, not /caches
+    assert get(base_url + "/geo-table")[0] == 200
+    status, caches = get(base_url + "/caches")
+    assert status == 200
+    return caches[0]["stars"]
+
+
+def test_rejects_non_positive_cell_size(server):
+    service, base_url = server
+    status, body = get(base_url + "/map?level=city&cell-size=0")
+    assert status == 400 and "cell-size" in body["error"]
+    assert get(base_url + "/map?level=city&cell-size=1")[0] == 200
+
+
+def test_unexpected_errors_return_500(server, monkeypatch):
+    service, base_url = server
+    monkeypatch.setattr(service, "geo_table", lambda name=None: 1 / 0)
+    status, body = get(base_url + "/geo-table")
+    assert status == 500 and "ZeroDivisionError" in body["error"]
+
+
+def bump_version(fname):
+    # Make sure that the server sees a new version, even if the file system's timestamps are coarse
+    st = os.stat(fname)
+    os.utime(fname, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+
+def test_ignores_partially_written_row(server):
+    service, base_url = server
+    with open("stars.csv", "a") as f:
+        f.write("b'partial',12")
+    bump_version("stars.csv")
+    assert get(base_url + "/geo-table")[0] == 200
+    assert get(base_url + "/time-series?group=monthly")[0] == 200
+    assert total_stars(base_url) == 300
+
+
+def test_keeps_serving_after_failed_reload(server):
+    service, base_url = server
+    with open("stars.csv", "a") as f:
+        f.write("not,a,complete,row\n")
+    bump_version("stars.csv")
+    status, table = get(base_url + "/geo-table")
+    assert status == 200 and table
+    assert total_stars(base_url) == 300
+    # The cache is loaded again once it is fixed
+    synthetic.generate_cache("stars.csv", 310, [{"name": "Paris", "country": "France", "subcountry": None}])
+    bump_version("stars.csv")
+    assert total_stars(base_url) == 310